@@ -12,8 +12,8 @@ The diary file can be exported to:
 import sys
 import os
 import argparse
-import glob
 import shutil
+import fnmatch
 import re
 import io
 import bisect
@@ -21,21 +21,24 @@ import locale
 import textwrap
 import base64
 import datetime
-import urllib
+import hashlib
+import json
+import urllib.parse
+import sqlite3
+import threading
+import contextlib
 
 from configparser import ConfigParser
 from collections import defaultdict
-from subprocess import check_output, CalledProcessError, STDOUT
-from urllib.request import urlopen
+from subprocess import run, PIPE, CalledProcessError, SubprocessError
+from time import perf_counter, sleep
 
 import colorama
-import clipboard
-import markdown
-import PIL
-from PIL import Image, ImageDraw, ImageChops
-from lxml import objectify
 from colorama import Fore, Style
 
+# markdown, PIL and concurrent.futures are imported by the functions using them
+# to keep the startup of commands which do not need them fast
+
 
 USAGE = """
 galerie --gallery <root-dir> [--sourcedir <media-dir>]
@@ -48,7 +51,17 @@ galerie --gallery <root-dir> [--sourcedir <media-dir>]
                              [--dest <directory>]
                              [--forcethumb]
                              [--enable_purge none|thumb|html|all]
-galerie --update  <root-dir>
+                             [--jobs <n>]
+                             [--purge_report]
+                             [--profile [summary*|cprofile]]
+                             [--progress stderr|<fd>]
+                             [--watch [<seconds>]]
+                             [--serve [<port>]]
+galerie --update  <root-dir> [--jobs <n>] [--purge_report]
+                             [--profile [summary*|cprofile]]
+                             [--progress stderr|<fd>]
+                             [--watch [<seconds>]]
+                             [--serve [<port>]]
 galerie --create  <root-dir> --sourcedir <media-dir>
                              [--recursive true|false*]
                              [--dates source*|<yyyymmdd-yyyymmdd>]
@@ -169,14 +182,99 @@ $('#btn_blog').click(function() {
 </script>
 '''
 
+# virtual grid: the thumbnails of each dcim block are read from the json data
+# file of the page and only the rows close to the viewport are rendered
+VGRID = '<div class="vgrid" data-gallery="%s" style="position:relative;"></div>'
+VGRID_SCRIPT = '''\
+<script>
+function vgrid(url) {
+  var gap = 4, overscan = 1000, pending = false;
+  var grids = $('div.vgrid').toArray();
+  if (!grids.length) return;
+
+  function layout(grid) {
+    var width = grid.clientWidth, x = 0, row = {top: 0, height: 0, cells: []};
+    grid.rows = [row];
+    grid.items.forEach(function(item, index) {
+      if (x + item[2] + gap > width && row.cells.length) {
+        row = {top: row.top + row.height, height: 0, cells: []};
+        grid.rows.push(row);
+        x = 0;
+      }
+      row.cells.push([index, x]);
+      x += item[2] + gap;
+      row.height = Math.max(row.height, item[3] + gap);
+    });
+    grid.layoutWidth = width;
+    grid.rendered = null;
+    grid.style.height = (row.top + row.height) + 'px';
+  }
+
+  function thumbnail(item, left, top) {
+    var link = document.createElement('a'), img = document.createElement('img');
+    link.href = item[0];
+    if (item[5]) link.rel = 'video';
+    link.style.cssText = 'position:absolute; left:' + left + 'px; top:' + top + 'px;';
+    img.src = item[1];
+    if (item[6]) img.srcset = item[1] + ' 1x, ' + item[6] + ' 2x';
+    img.width = item[2];
+    img.height = item[3];
+    img.title = item[4];
+    img.loading = 'lazy';
+    link.appendChild(img);
+    return link;
+  }
+
+  function render() {
+    pending = false;
+    grids.forEach(function(grid) {
+      if (!grid.items) return;
+      if (grid.layoutWidth != grid.clientWidth) layout(grid);
+      var top = grid.getBoundingClientRect().top, first = -1, last = -1;
+      grid.rows.forEach(function(row, index) {
+        if (top + row.top + row.height > -overscan && top + row.top < window.innerHeight + overscan) {
+          if (first < 0) first = index;
+          last = index;
+        }
+      });
+      if (grid.rendered === first + ':' + last) return;
+      grid.rendered = first + ':' + last;
+      var fragment = document.createDocumentFragment();
+      for (var i = first; first >= 0 && i <= last; i++) {
+        grid.rows[i].cells.forEach(function(cell) {
+          fragment.appendChild(thumbnail(grid.items[cell[0]], cell[1], grid.rows[i].top));
+        });
+      }
+      grid.replaceChildren(fragment);
+    });
+  }
+
+  function schedule() {
+    if (!pending) {
+      pending = true;
+      window.requestAnimationFrame(render);
+    }
+  }
+
+  $.getJSON(url, function(data) {
+    grids.forEach(function(grid) { grid.items = data[grid.dataset.gallery] || []; });
+    $(window).on('scroll resize', schedule);
+    $('button').on('click', schedule);
+    render();
+  });
+}
+</script>
+'''
+VGRIDCALL = "<script>vgrid('%s');</script>"
+
 SUBDIR_BACKCOL = '#eee'
 END = '</div>\n</body>\n</html>'
 SEP = '<hr class="thin">'
-IMGPOST = '<a href="%s"><img src="%s" width="%d" height="%d" title="%s" loading="lazy"></a>'
+IMGPOST = '<a href="%s"><img src="%s"%s width="%d" height="%d" title="%s" loading="lazy"></a>'
 VIDPOST = '<a href="%s" rel="video"><img src="%s" width="%d" height="%d" title="%s"></a>'
 IMGPOSTCAPTION = '''\
 <div style="display:inline-grid; margin-bottom:5px;">
-<a href="%s"><img src=%s width="%d" height="%d" title="%s"></a>
+<a href="%s"><img src=%s%s width="%d" height="%d" title="%s"></a>
 <p>%s</p>
 </div>
 '''
@@ -186,8 +284,14 @@ VIDPOSTCAPTION = '''\
 <p>%s</p>
 </div>
 '''
-IMGDCIM = '<a href="%s"><img src="%s" width="%d" height="%d" title="%s"></a>'
+IMGDCIM = '<a href="%s"><img src="%s"%s width="%d" height="%d" title="%s"></a>'
 VIDDCIM = '<a href="%s" rel="video"><img src="%s" width="%d" height="%d" title="%s"></a>'
+# thumbnails drawn from a sprite: transparent image on top of the sprite background,
+# the thumbnail itself is given to photobox with the data-src attribute
+BLANK_GIF = 'data:image/gif;base64,R0lGODlhAQABAIAAAAAAAP///yH5BAEAAAAALAAAAAABAAEAAAIBRAA7'
+SPRITEBACK = 'style="background: url(\'%s\') -%dpx -%dpx;"'
+IMGSPRITE = f'<a href="%s"><img src="{BLANK_GIF}" data-src="%s" {SPRITEBACK} width="%d" height="%d" title="%s"></a>'
+VIDSPRITE = f'<a href="%s" rel="video"><img src="{BLANK_GIF}" data-src="%s" {SPRITEBACK} width="%d" height="%d" title="%s"></a>'
 
 # diminution de l'espace entre images, on utilise :
 # "display: block;", "margin-bottom: 0em;" et "font-size: 0;"
@@ -213,6 +317,9 @@ CAPTION_PAT = '''\
 </div>
 '''
 
+PAGENAV = '<p>%s</p>'
+PAGELINK = '<a href="%s">%s</a>'
+PAGEINDEX = '<li><a href="%s">%s</a></li>'
 MAPFRAME = '<iframe src="%s" title="Carte" style="width:100%%;" height="300"></iframe>'
 FULLSCREEN_ICON = '<img src="https://cdnjs.cloudflare.com/ajax/libs/leaflet.fullscreen/1.4.2/icon-fullscreen.png" style="vertical-align:bottom;"  width="16" height="16" alt="Fullscreen icon">'
 
@@ -237,37 +344,42 @@ class Post:
         return self.date == other.date or self.__lt__(other)
 
     @classmethod
-    def from_markdown(cls, post):
-        m = re.match(r'\[(\d\d\d\d/\d\d/\d\d)\]\s*(\[ignore\])?\n*', post[0])
-        if m:
-            date = m.group(1).replace('/', '')
+    def from_markdown(cls, post, lineno=None):
+        """
+        Make a post from the lines of a record, walking an index over them.
+        lineno is the line number of the first line of the record in the
+        diary file (for error messages).
+        """
+        index, end = 0, len(post)
+        if post and (match := POST_DATE_PATTERN.match(post[0])):
+            date = match.group(1).replace('/', '')
             if not validate_date(date):
-                error('Incorrect date value:', date)
-            ignore = True if m.group(2) else False
-            del post[0]
+                error('Incorrect date value:', date, *line_location(lineno))
+            ignore = True if match.group(2) else False
+            index += 1
         else:
             date = None
             ignore = False
 
-        while post and not post[0].strip():
-            del post[0]
+        while index < end and not post[index].strip():
+            index += 1
 
-        text = ''
-        while post and not re.match(r'!?\[\]', post[0]):
-            text += post[0]
-            del post[0]
+        start = index
+        while index < end and not POST_MEDIA_START.match(post[index]):
+            index += 1
+        text = ''.join(post[start:index])
 
         # remove empty lines at end
-        text = re.sub(r'\n\n$', '\n', text)
+        text = POST_TEXT_END.sub('\n', text)
 
         medias = list()
-        while post and (match := re.match(r'!?\[\]\((.*)\)', post[0])):
+        while index < end and (match := POST_MEDIA_PATTERN.match(post[index])):
             media = match.group(1)
             caption = None
-            del post[0]
-            if post and not re.match(r'!?\[\]', post[0]):
-                caption = post[0].strip()
-                del post[0]
+            index += 1
+            if index < end and not POST_MEDIA_START.match(post[index]):
+                caption = post[index].strip()
+                index += 1
             if match.group(0)[0] == '!':
                 medias.append(PostImage(caption, media))
             else:
@@ -294,7 +406,7 @@ class Post:
         html = list()
         if self.text:
             # possible with --bydate
-            html.append(markdown.markdown(self.text))
+            html.append(render_markdown(args, self.text))
         subdirs, dcim = dispatch_post_items(self.dcim)
         if self.dcim:
             html.append(SEP)
@@ -302,13 +414,19 @@ class Post:
             html.append(media.to_html_dcim(args))
         if dcim:
             html.append(f'<div id="gallery-dcim-{self.date}-{self.daterank}">')
-            for media in dcim:
-                html.append(media.to_html_dcim(args))
+            html.extend(self.dcim_to_html(args, dcim))
             html.append('</div>')
 
         html.append(SEP)
         return html
 
+    def lastdate(self):
+        # value of {LASTDATE}: date of the last post of the diary
+        for post in self.parent[::-1]:
+            if post.date is not None and post.ignore is False:
+                return post.date.replace('/', '')
+        return None
+
     def to_html_diary(self, args):
         if self.ignore and not args.sourcedir:
             return []
@@ -334,13 +452,10 @@ class Post:
                 else:
                     text = re.sub('{MAPFULL [^}]+}', '', text)
             text = text.replace('{FULLSCREEN_ICON}', FULLSCREEN_ICON)
-            if args.daily_anchors:
-                for post in self.parent[::-1]:
-                    if post.date is not None and post.ignore is False:
-                        text = text.replace('{LASTDATE}', post.date.replace('/', ''))
-                        break
+            if args.daily_anchors and (lastdate := self.lastdate()) is not None:
+                text = text.replace('{LASTDATE}', lastdate)
 
-            html_text = markdown.markdown(text)
+            html_text = render_markdown(args, text)
             html_text = html_text.replace('<p>', '<p class="text">')
             html.append(html_text)
 
@@ -354,8 +469,7 @@ class Post:
         if dcim:
             html.append(f'<div id="gallery-dcim-{self.date}-{self.daterank}">')
             html.append(SEP)
-            for media in dcim:
-                html.append(media.to_html_dcim(args))
+            html.extend(self.dcim_to_html(args, dcim))
             html.append('</div>')
 
         html.append(SEP)
@@ -363,7 +477,18 @@ class Post:
             html.append('</div>')
         return html
 
+    def dcim_to_html(self, args, dcim):
+        if args.thumbnails.grid == 'virtual':
+            return [VGRID % f'gallery-dcim-{self.date}-{self.daterank}']
+        else:
+            return [media.to_html_dcim(args) for media in dcim]
+
+    def to_grid_data(self, args):
+        _, dcim = dispatch_post_items(self.dcim)
+        return [media.to_grid_data(args) for media in dcim]
+
     def to_html_blogger(self):
+        import markdown
         html = list()
         html.append(markdown.markdown(self.text))
         for image in self.medias:
@@ -381,6 +506,19 @@ class PostItem:
         self.thumbsize = thumbsize
         self.descr = descr
         self.resized_url = None
+        self.date = None
+        self.time = None
+        self.thumb2x = None
+        self.thumbsize2x = None
+        self.sprite = None
+
+    def srcset(self):
+        # srcset and sizes attributes when there is a thumbnail for high density screens
+        if self.thumb2x is None:
+            return ''
+        else:
+            width, width2x = self.thumbsize[0], self.thumbsize2x[0]
+            return f' srcset="{self.thumb} {width}w, {self.thumb2x} {width2x}w" sizes="{width}px"'
 
 
 class PostImage(PostItem):
@@ -393,13 +531,19 @@ class PostImage(PostItem):
     def to_html_post(self, args):
         descr = self.descr if args.thumbnails.media_description else ''
         if not self.caption:
-            return IMGPOST % (self.uri, self.thumb, *self.thumbsize, descr)
+            return IMGPOST % (self.uri, self.thumb, self.srcset(), *self.thumbsize, descr)
         else:
-            return IMGPOSTCAPTION % (self.uri, self.thumb, *self.thumbsize, descr, self.caption)
+            return IMGPOSTCAPTION % (self.uri, self.thumb, self.srcset(), *self.thumbsize, descr, self.caption)
 
     def to_html_dcim(self, args):
         descr = self.descr if args.thumbnails.media_description else ''
-        return IMGDCIM % (relative_url(self.uri, args.root), self.thumb, *self.thumbsize, descr)
+        if self.sprite:
+            return IMGSPRITE % (relative_url(self.uri, args.root), self.thumb, *self.sprite, *self.thumbsize, descr)
+        return IMGDCIM % (relative_url(self.uri, args.root), self.thumb, self.srcset(), *self.thumbsize, descr)
+
+    def to_grid_data(self, args):
+        descr = self.descr if args.thumbnails.media_description else ''
+        return [relative_url(self.uri, args.root), self.thumb, *self.thumbsize, descr, 0, self.thumb2x or '']
 
     def to_html_blogger(self):
         if not self.caption:
@@ -424,8 +568,14 @@ class PostVideo(PostItem):
 
     def to_html_dcim(self, args):
         descr = self.descr if args.thumbnails.media_description else ''
+        if self.sprite:
+            return VIDSPRITE % (relative_url(self.uri, args.root), self.thumb, *self.sprite, *self.thumbsize, descr)
         return VIDDCIM % (relative_url(self.uri, args.root), self.thumb, *self.thumbsize, descr)
 
+    def to_grid_data(self, args):
+        descr = self.descr if args.thumbnails.media_description else ''
+        return [relative_url(self.uri, args.root), self.thumb, *self.thumbsize, descr, 1, '']
+
     def to_html_blogger(self):
         x = f'<p style="text-align: center;">{self.iframe}</p>'
         if not self.caption:
@@ -437,10 +587,6 @@ class PostVideo(PostItem):
 class PostSubdir(PostItem):
     def to_html_dcim(self, args):
         basename = os.path.basename(self.htmname)
-        posts = self.posts
-        title = self.caption
-        print_html(args, posts, title, self.htmname)
-
         if not self.caption:
             return DIRPOST % (basename, self.thumb, *self.thumbsize)
         else:
@@ -464,58 +610,73 @@ def relative_url(path, root):
 # -- Markdown parser ----------------------------------------------------------
 
 
-def parse_markdown_records(filename):
+POST_DATE_PATTERN = re.compile(r'\[(\d\d\d\d/\d\d/\d\d)\]\s*(\[ignore\])?\n*')
+POST_MEDIA_START = re.compile(r'!?\[\]')
+POST_MEDIA_PATTERN = re.compile(r'!?\[\]\((.*)\)')
+POST_TEXT_END = re.compile(r'\n\n$')
+
+
+def line_location(lineno):
+    # complement of error messages about diary records
+    return () if lineno is None else (f'(line {lineno})',)
+
+
+def markdown_records(stream):
     """
-    Records are separated by '___'. Return list of records (without '___') as
-    lists of lines. First line of first record is possibly a title.
+    Records are separated by '___'. Return the title (first line of first
+    record, possibly) and a generator of records (without '___') as tuples
+    (line number of first line, list of lines).
     """
-    if not os.path.exists(filename):
-        error('File not found', filename)
+    lines = enumerate(stream, 1)
+    first = next(lines, None)
+    if first is None:
+        return None, iter(())
+
+    lineno, line = first
+    if line.startswith('# '):
+        title = line[2:].strip()
+        start, record = lineno + 2, []
+        if next(lines, None) is None:
+            warning('Only title in diary.')
+    else:
+        title = None
+        start, record = lineno, [line]
 
-    records = []
-    with open(filename, encoding='utf-8') as f:
-        line = next(f)
-        if line.startswith('# '):
-            title = line[2:].strip()
-            record = []
-            try:
-                next(f)
-            except StopIteration:
-                warning('Only title in diary.')
-        else:
-            title = None
-            record = [line]
-        for line in f:
+    def records(start, record):
+        for lineno, line in lines:
             if not line.startswith('___'):
                 record.append(line)
             else:
-                records.append(record)
-                record = []
+                yield start, record
+                start, record = lineno + 1, []
 
-    return title, records
+    return title, records(start, record)
 
 
 def parse_markdown(filename):
     """
-    Generate Post objects from markdown. Posts must be ordered by date.
+    Generate Post objects from markdown in a single pass over the diary file.
+    Posts must be ordered by date.
     """
-    title, records = parse_markdown_records(filename)
-    posts = [Post.from_markdown(record) for record in records]
-
-    # set parent
-    for post in posts:
-        post.parent = posts
+    if not os.path.exists(filename):
+        error('File not found', filename)
 
-    # set rank of posts in date
+    posts = list()
     daterank = defaultdict(int)
-    for post in posts:
-        daterank[post.date] += 1
-        post.daterank = daterank[post.date]
+    with open(filename, encoding='utf-8') as f:
+        title, records = markdown_records(f)
+        for lineno, record in records:
+            post = Post.from_markdown(record, lineno)
 
-    # check post order
-    for post1, post2 in zip(posts[:-1], posts[1:]):
-        if not (post1 <= post2):
-            error('Posts are not ordered', f'{post1.date} > {post2.date}')
+            # check post order
+            if posts and not (posts[-1] <= post):
+                error('Posts are not ordered', f'{posts[-1].date} > {post.date}', *line_location(lineno))
+
+            # set rank of posts in date and parent
+            daterank[post.date] += 1
+            post.daterank = daterank[post.date]
+            post.parent = posts
+            posts.append(post)
 
     return title, posts
 
@@ -547,78 +708,340 @@ def print_markdown(posts, title, fullname):
 # -- html printer -------------------------------------------------------------
 
 
+MARKDOWN = None
+
+
+def render_markdown(args, text):
+    """
+    Render markdown text to html. Fragments are cached in the catalog with the
+    hash of the text as key, misses are rendered by a single Markdown instance
+    reset between texts.
+    """
+    global MARKDOWN
+    import markdown
+    with args.profiler.phase('markdown'):
+        key = signature(markdown.__version__, text)
+        html = args.catalog.fragment(key)
+        if html is None:
+            if MARKDOWN is None:
+                MARKDOWN = markdown.Markdown()
+            html = MARKDOWN.reset().convert(text)
+            args.catalog.record_fragment(key, html)
+    return html
+
+
 def compose_html_reduced(args, posts, title, target):
-    html = list()
-    html.append(START % title)
+    yield START % title
 
     for post in posts:
         for line in post.to_html(args, target):
-            html.append(line.strip())
-        html.append('')
+            yield line.strip()
+        yield ''
 
-    html.append(END)
-    return html
+    yield END
 
 
-def compose_html_full(args, posts, title, target):
-    html = list()
-    html.append(START % title)
+def compose_html_full(args, posts, title, target, header=(), footer=(), data_url=None):
+    yield START % title
 
     if args.diary:
         if args.sourcedir:
-            html.append(BUTTONS_FULL)
-            html.append(BUTTONS_SCRIPTS)
+            yield BUTTONS_FULL
+            yield BUTTONS_SCRIPTS
         # not necessary
         # else:
-            # html.append(BUTTONS_DIARY)
-            # html.append(BUTTONS_SCRIPTS)
+            # yield BUTTONS_DIARY
+            # yield BUTTONS_SCRIPTS
+
+    yield from header
 
     for post in posts:
         for line in post.to_html(args, target):
-            html.append(line.strip())
-        html.append('')
+            yield line.strip()
+        yield ''
+
+    yield from footer
+
+    if data_url:
+        yield VGRID_SCRIPT
+        yield VGRIDCALL % data_url
 
-    html.append('<script>')
+    yield '<script>'
     for post in posts:
         if post.medias:
             gallery_id = f'gallery-blog-{post.date}-{post.daterank}'
-            html.append(gallery_call(args, gallery_id))
+            yield gallery_call(args, gallery_id)
         if post.dcim:
             gallery_id = f'gallery-dcim-{post.date}-{post.daterank}'
-            html.append(gallery_call(args, gallery_id))
-    html.append('</script>')
+            yield gallery_call(args, gallery_id)
+    yield '</script>'
 
-    html.append(END)
-    return html
+    yield END
 
 
-def print_html_to_stream(args, posts, title, stream, target):
+def compose_html(args, posts, title, target):
     if target == 'regular':
-        for line in compose_html_full(args, posts, title, target):
-            print(line, file=stream)
+        return compose_html_full(args, posts, title, target)
     else:
-        for line in compose_html_reduced(args, posts, title, target):
-            print(line, file=stream)
+        return compose_html_reduced(args, posts, title, target)
+
+
+def print_html_to_stream(args, posts, title, stream, target):
+    for line in compose_html(args, posts, title, target):
+        print(line, file=stream)
 
 
 def print_html(args, posts, title, html_name, target='regular'):
     assert target == 'regular'
-    with io.StringIO() as f:
-        print_html_to_stream(args, posts, title, f, target)
-        html = f.getvalue()
-
     if html_name:
-        if os.path.exists(html_name):
-            # test if the generated html is identical to the one already on disk
-            with open(html_name, 'rt', encoding='utf-8') as f:
-                html0 = f.read()
-            if html == html0:
-                return None
-        with open(html_name, 'wt', encoding='utf-8') as f:
-            f.write(html)
+        pages = html_pages(args, posts, html_name)
+        if len(pages) == 1:
+            print_html_page(args, posts, title, html_name)
+        else:
+            print_html_paginated(args, pages, title)
         return None
     else:
-        return html
+        with io.StringIO() as f:
+            print_html_to_stream(args, posts, title, f, target)
+            return f.getvalue()
+
+
+def print_html_page(args, posts, title, html_name, header=(), footer=()):
+    output = relative_output(args, html_name)
+    signature = page_signature(args, posts, title, header, footer)
+    if args.thumbnails.grid == 'virtual':
+        data_name = grid_data_name(args, html_name)
+        data_url = relative_output(args, data_name)
+        print_grid_data(args, posts, data_name, signature)
+    else:
+        data_url = None
+    if args.catalog.is_uptodate(output, signature):
+        return
+    lines = compose_html_full(args, posts, title, 'regular', header, footer, data_url)
+    write_output(args, html_name, lines)
+    args.catalog.record_output(output, signature)
+    args.catalog.record_page_fragments(output)
+
+
+def grid_data_name(args, html_name):
+    basename = os.path.splitext(os.path.basename(html_name))[0]
+    return os.path.join(args.thumbdir, basename + '.json')
+
+
+def print_grid_data(args, posts, data_name, page_signature):
+    """
+    Write the json data file of a page with virtual grid: for each dcim block,
+    the list of [target, thumbnail, width, height, description, is_video,
+    hidpi thumbnail] of its items.
+    """
+    output = relative_output(args, data_name)
+    if args.catalog.is_uptodate(output, page_signature):
+        return
+    data = dict()
+    for post in posts:
+        if items := post.to_grid_data(args):
+            data[f'gallery-dcim-{post.date}-{post.daterank}'] = items
+    write_output(args, data_name, [json.dumps(data, ensure_ascii=False, separators=(',', ':'))])
+    args.catalog.record_output(output, page_signature)
+
+
+def print_html_paginated(args, pages, title):
+    """
+    Print the index page (undated posts and links to the pages) and the pages
+    of the groups of dated posts with links to the index and to the previous
+    and next pages.
+    """
+    (index_name, leading, _), *pages = pages
+    index_basename = os.path.basename(index_name)
+    links = [PAGEINDEX % (os.path.basename(name), label) for name, _, label in pages]
+    print_html_page(args, leading, title, index_name, footer=['<ul>', *links, '</ul>'])
+
+    for rank, (html_name, posts, label) in enumerate(pages):
+        nav = [PAGELINK % (index_basename, title)]
+        if rank > 0:
+            name, _, prevlabel = pages[rank - 1]
+            nav.append(PAGELINK % (os.path.basename(name), '&lt; ' + prevlabel))
+        if rank < len(pages) - 1:
+            name, _, nextlabel = pages[rank + 1]
+            nav.append(PAGELINK % (os.path.basename(name), nextlabel + ' &gt;'))
+        nav = [PAGENAV % ' | '.join(nav)]
+        print_html_page(args, posts, f'{title} - {label}', html_name, nav, nav)
+
+
+def html_pages(args, posts, html_name):
+    """
+    Return the list of pages of an html output as (html_name, posts, label)
+    tuples. Without pagination, or with a single group of dated posts, there
+    is a single page with all posts. Otherwise, the first page is the index
+    with the leading undated posts (diary header, subdirectories) followed by
+    a page per group of dated posts named after the group
+    (index-200001.htm for month pagination).
+    """
+    if args.paginate is None:
+        return [(html_name, posts, None)]
+
+    leading, groups = list(), list()
+    for post in posts:
+        undated = post.date is None or post.date == '00000000'
+        if undated and not groups:
+            leading.append(post)
+        elif undated or groups and is_same_page(args, groups[-1], post.date):
+            groups[-1].append(post)
+        else:
+            groups.append([post])
+
+    if len(groups) < 2:
+        return [(html_name, posts, None)]
+
+    stem, ext = os.path.splitext(html_name)
+    pages = [(html_name, leading, None)]
+    for group in groups:
+        dates = [post.date for post in group if post.date not in (None, '00000000')]
+        if args.paginate == 'month':
+            key = dates[0][:6]
+            label = datetime.datetime.strptime(key, '%Y%m').strftime('%B %Y').capitalize()
+        elif args.paginate == 'year':
+            key = label = dates[0][:4]
+        else:
+            key = dates[0]
+            first, last = (datetime.datetime.strptime(date, '%Y%m%d') for date in (dates[0], dates[-1]))
+            label = first.strftime('%d/%m/%Y')
+            if last != first:
+                label += ' - ' + last.strftime('%d/%m/%Y')
+        pages.append((f'{stem}-{key}{ext}', group, label))
+    return pages
+
+
+def is_same_page(args, group, date):
+    dates = [post.date for post in group if post.date not in (None, '00000000')]
+    if args.paginate == 'month':
+        return dates[0][:6] == date[:6]
+    elif args.paginate == 'year':
+        return dates[0][:4] == date[:4]
+    else:
+        return date in dates or len(set(dates)) < args.paginate
+
+
+def write_output(args, fullname, lines):
+    """
+    Write lines to a temporary file while hashing them. The temporary file
+    replaces the output only if the hash differs from the one recorded in the
+    manifest (the previous content is never read back).
+    """
+    dirname, basename = os.path.split(fullname)
+    tmpname = os.path.join(dirname, f'.{basename}.{os.getpid()}.tmp')
+    hasher = hashlib.sha1()
+    try:
+        with open(tmpname, 'wb') as f:
+            for line in lines:
+                data = line + '\n'
+                if os.linesep != '\n':
+                    data = data.replace('\n', os.linesep)
+                data = data.encode('utf-8')
+                hasher.update(data)
+                f.write(data)
+        output = relative_output(args, fullname)
+        digest = hasher.hexdigest()
+        if digest == args.catalog.file_hash(output) and os.path.exists(fullname):
+            os.remove(tmpname)
+        else:
+            os.replace(tmpname, fullname)
+            args.catalog.record_file(output, digest)
+    except BaseException:
+        if os.path.exists(tmpname):
+            os.remove(tmpname)
+        raise
+
+
+def print_subdir_pages(args, posts):
+    """
+    Print the pages of the subdirectories referenced by posts, recursively.
+    """
+    for post in posts:
+        for item in post.dcim:
+            if type(item) is PostSubdir:
+                print_html(args, item.posts, item.caption, item.htmname)
+                print_subdir_pages(args, item.posts)
+
+
+# -- Dependencies of outputs --------------------------------------------------
+
+
+def signature(*inputs):
+    return hashlib.sha1(repr(inputs).encode('utf-8')).hexdigest()
+
+
+def relative_output(args, fullname):
+    return os.path.relpath(fullname, args.dest).replace('\\', '/')
+
+
+def page_signature(args, posts, title, header=(), footer=()):
+    """
+    Signature of the inputs of an html page: templates, relevant configuration
+    values, posts and their items, navigation lines of paginated pages. Pages
+    of subdirectories are not inputs of the parent page, only their names and
+    thumbnails. The date of the last post of the diary is an input of the
+    pages with posts using it.
+    """
+    config = (
+        args.diary, bool(args.sourcedir), args.daily_anchors, args.local_map,
+        args.thumbnails.media_description, args.thumbnails.grid, sorted(vars(args.photobox).items())
+    )
+    templates = (
+        START, END, SEP, BUTTONS_FULL, BUTTONS_SCRIPTS, GOOGLE_TRANSLATE, MAPFRAME,
+        FULLSCREEN_ICON, GALLERYCALL, IMGPOST, VIDPOST, IMGPOSTCAPTION, VIDPOSTCAPTION,
+        IMGDCIM, VIDDCIM, IMGSPRITE, VIDSPRITE, DIRPOST, DIRPOSTCAPTION, VGRID, VGRID_SCRIPT,
+        VGRIDCALL
+    )
+    content = list()
+    for post in posts:
+        content.append((post.date, post.daterank, post.text, post.extra, post.ignore))
+        if args.daily_anchors and post.text and '{LASTDATE}' in post.text:
+            content.append(post.lastdate())
+        content.append([item_signature(args, item) for item in post.medias])
+        content.append([item_signature(args, item) for item in post.dcim])
+    return signature(title, config, templates, content, header, footer)
+
+
+def item_signature(args, item):
+    if type(item) is PostSubdir:
+        return (item.htmname, item.thumb, item.thumbsize, item.caption)
+    else:
+        return (type(item).__name__, item.uri, item.thumb, item.thumbsize, item.thumb2x,
+                item.thumbsize2x, item.sprite, item.descr, item.caption)
+
+
+def mosaic_fingerprint(size, items, thumbdir, save_options):
+    """
+    Fingerprint of the inputs of a subdir thumbnail once the thumbnails of its
+    items are made: geometry, and name, size and modification time of the
+    thumbnails included in the mosaic.
+    """
+    widthnum, heightnum, *_ = mosaic_geometry(size, items)
+    content = list()
+    for item in items[:widthnum * heightnum]:
+        thumb_name = os.path.join(thumbdir, os.path.basename(item.thumb))
+        try:
+            stat = os.stat(thumb_name)
+            content.append((thumb_name, stat.st_size, stat.st_mtime_ns))
+        except OSError:
+            content.append((thumb_name, None))
+    return signature(size, len(items), content, sorted(save_options.items()))
+
+
+def sprite_fingerprint(size, thumbs, save_options):
+    """
+    Fingerprint of the inputs of a sprite once its thumbnails are made: size,
+    and name, position, size and modification time of the thumbnails.
+    """
+    content = list()
+    for thumb_name, x, y in thumbs:
+        try:
+            stat = os.stat(thumb_name)
+            content.append((thumb_name, x, y, stat.st_size, stat.st_mtime_ns))
+        except OSError:
+            content.append((thumb_name, x, y, None))
+    return signature(size, content, sorted(save_options.items()))
 
 
 GALLERYCALL = """
@@ -675,26 +1098,22 @@ def validate_date(datestr):
         return False
 
 
+DATE_PATTERN = re.compile(r'(?:\D|^)(\d{8})(?:\D|$)', re.ASCII)
+TIME_PATTERN = re.compile(r'(?:\D|^)(\d{8})\D(\d{6})(?:\D|$)', re.ASCII)
+
+
 def date_from_name(name):
     # heuristics
-    if match := re.search(r'(?:\D|^)(\d{8})(?:\D|$)', name, re.ASCII):
+    if match := DATE_PATTERN.search(name):
         digits = match.group(1)
         if validate_date(digits):
             return digits
     return None
 
 
-def date_from_item(filename):
-    if date := date_from_name(filename):
-        return date
-    else:
-        timestamp = os.path.getmtime(filename)
-        return datetime.datetime.fromtimestamp(timestamp).strftime('%Y%m%d')
-
-
 def time_from_name(name):
     # heuristics
-    if match := re.search(r'(?:\D|^)(\d{8})\D(\d{6})(?:\D|$)', name, re.ASCII):
+    if match := TIME_PATTERN.search(name):
         digits = match.group(2)
         hour, minute, second = int(digits[0:2]), int(digits[2:4]), int(digits[4:6])
         if 0 <= hour < 24 and 0 <= minute < 60 and 0 <= second < 60:
@@ -702,72 +1121,200 @@ def time_from_name(name):
     return None
 
 
-def time_from_item(filename):
-    if time := time_from_name(filename):
-        return time
-    else:
-        timestamp = os.path.getmtime(filename)
-        return datetime.datetime.fromtimestamp(timestamp).strftime('%H%M%S')
+def media_timestamp(args, filename):
+    """
+    Return date (yyyymmdd) and time (hhmmss) of a media, from its name or
+    from its modification time. Resolved once per run.
+    """
+    if filename not in args.timestamps:
+        date = date_from_name(filename)
+        time = time_from_name(filename)
+        if date is None or time is None:
+            mtime = datetime.datetime.fromtimestamp(media_stat(args, filename).st_mtime)
+            date = date or mtime.strftime('%Y%m%d')
+            time = time or mtime.strftime('%H%M%S')
+        args.timestamps[filename] = date, time
+    return args.timestamps[filename]
 
 
 FFPROBE_CMD = '''\
     ffprobe -v error
             -select_streams v:0
-            -show_entries stream=width,height,avg_frame_rate,r_frame_rate:format=duration
-            -of csv=p=0
+            -show_streams
+            -show_format
+            -of json
 '''
 
+# seconds
+FFPROBE_TIMEOUT = 60
+
+# result of the search for ffmpeg and ffprobe, made when meeting the first video
+FFMPEG_CHECKED = False
+
+
+def check_ffmpeg():
+    """
+    Check for ffmpeg and ffprobe in path, once.
+    """
+    global FFMPEG_CHECKED
+    if not FFMPEG_CHECKED:
+        for exe in ('ffmpeg', 'ffprobe'):
+            if shutil.which(exe) is None:
+                error('File not found', exe)
+        FFMPEG_CHECKED = True
+
+
+def get_image_info(args, filename):
+    stat = media_stat(args, filename)
+    info = args.catalog.get(filename, stat)
+    if info is None:
+        with args.profiler.phase('probe'):
+            info = make_image_info(filename, stat, *media_timestamp(args, filename))
+        args.catalog.put(filename, stat, info)
+    date, time, width, height, size = info
+    return info, f'{date} {time}, dim={width}x{height}, {size} MB'
 
-def get_image_info(filename):
-    date = date_from_item(filename)
-    time = time_from_item(filename)
+
+def make_image_info(filename, stat, date, time):
+    from PIL import Image
     img = Image.open(filename)
     width, height = img.size
-    size = round(os.path.getsize(filename) / 1e6, 1)
-    return (date, time, width, height, size), f'{date} {time}, dim={width}x{height}, {size} MB'
+    size = round(stat.st_size / 1e6, 1)
+    return date, time, width, height, size
+
+
+def get_video_info(args, filename, info_fullname):
+    stat = media_stat(args, filename)
+    info = args.catalog.get(filename, stat)
+    if info is None:
+        if (msg := args.catalog.probe_error(filename, stat)) is not None:
+            raise ValueError(msg)
+        elif os.path.exists(info_fullname):
+            # galleries made before the catalog store video info in .info files
+            info = read_video_info_file(info_fullname)
+            os.remove(info_fullname)
+        else:
+            check_ffmpeg()
+            with args.profiler.phase('probe'):
+                info = make_video_info(filename, stat, *media_timestamp(args, filename))
+        args.catalog.put(filename, stat, info)
+    return info, format_video_info(*info)
 
 
-def get_video_info(filename, info_fullname):
-    if os.path.exists(info_fullname):
-        with open(info_fullname) as f:
-            info = f.readline().split()
-        date, time, width, height, size, duration, fps = info[0], info[1], int(info[2]), int(info[3]), float(info[4]), int(info[5]), float(info[6])
-        formatted_info = format_video_info(date, time, width, height, size, duration, fps)
-        return (date, time, width, height, size, duration, fps), formatted_info
-    else:
-        info, formatted_info = make_video_info(filename, info_fullname)
-        with open(info_fullname, 'wt') as f:
-            print(' '.join([str(_) for _ in info]), file=f)
-        return info, formatted_info
+def video_info_name(thumbdir, media_fullname, sourcedir, key):
+    # name of .info files used before the catalog
+    thumb_basename = thumbname(relative_name(media_fullname, sourcedir), key)
+    return os.path.join(thumbdir, os.path.splitext(thumb_basename)[0] + '.info')
+
+
+def read_video_info_file(info_fullname):
+    with open(info_fullname) as f:
+        info = f.readline().split()
+    return info[0], info[1], int(info[2]), int(info[3]), float(info[4]), int(info[5]), float(info[6])
 
 
-def make_video_info(filename, info_fullname):
+def make_video_info(filename, stat, date, time):
     # ffmpeg must be in path
-    date = date_from_item(filename)
-    time = time_from_item(filename)
-    command = [*FFPROBE_CMD.split(), filename]
     try:
-        output = check_output(command, stderr=STDOUT).decode()
-        width, height, fps, duration = parse_ffprobe_output(output)
-        size = round(os.path.getsize(filename) / 1e6, 1)
-        output = format_video_info(date, time, width, height, size, duration, fps)
+        width, height, fps, duration = run_ffprobe(filename)
     except CalledProcessError as e:
-        output = e.output.decode()
-        warning(output)
+        warning(e.output.decode())
         raise
-    return (date, time, width, height, size, duration, fps), output
+    size = round(stat.st_size / 1e6, 1)
+    return date, time, width, height, size, duration, fps
+
+
+def run_ffprobe(filename):
+    command = [*FFPROBE_CMD.split(), filename]
+    result = run_subprocess(command, stdout=PIPE, stderr=PIPE, timeout=FFPROBE_TIMEOUT)
+    if result.returncode:
+        raise CalledProcessError(result.returncode, command, result.stdout + result.stderr)
+    return parse_ffprobe_output(result.stdout.decode())
 
 
 def parse_ffprobe_output(ffprobe_output):
-    # parse first channel data and last line for duration
-    match = re.match(r'(\d+),(\d+),(\d+)/(\d+),(\d+/\d+).*\s(\d+\.\d+)', ffprobe_output, re.DOTALL)
-    width = int(match.group(1))
-    height = int(match.group(2))
-    fps = round(int(match.group(3)) / int(match.group(4)), 1)
-    duration = round(float(match.group(6)))
+    """
+    Return width, height, fps and duration from the json output of ffprobe.
+    Width and height are given as displayed, i.e. after rotation. Raise
+    ValueError if some value is missing.
+    """
+    try:
+        data = json.loads(ffprobe_output)
+        stream = data['streams'][0]
+        width = int(stream['width'])
+        height = int(stream['height'])
+        fps = parse_frame_rate(stream.get('avg_frame_rate'))
+        if fps is None:
+            fps = parse_frame_rate(stream.get('r_frame_rate')) or 0.0
+        duration = data.get('format', {}).get('duration') or stream.get('duration')
+        duration = round(float(duration))
+    except (KeyError, IndexError, TypeError, json.JSONDecodeError) as exc:
+        raise ValueError(f'Unable to parse ffprobe output ({exc})')
+
+    rotation = stream.get('tags', {}).get('rotate', 0)
+    for side_data in stream.get('side_data_list', []):
+        rotation = side_data.get('rotation', rotation)
+    if int(float(rotation)) % 180 != 0:
+        width, height = height, width
+
     return width, height, fps, duration
 
 
+def parse_frame_rate(frame_rate):
+    # frame_rate: 'num/den', returns None if unknown
+    try:
+        num, den = frame_rate.split('/')
+        return round(int(num) / int(den), 1)
+    except (AttributeError, ValueError, ZeroDivisionError):
+        return None
+
+
+def probe_videos(args, medias, sourcedir, key):
+    """
+    Describe in the catalog the videos in medias which are not yet described.
+    ffprobe is run in several concurrent processes. Failures are recorded in
+    the catalog to be reported when creating the items, and to probe again
+    only the videos which have changed.
+    """
+    videos = list()
+    for media_fullname in medias:
+        if is_video_file(media_fullname) and not is_source_subdir(args, media_fullname):
+            stat = media_stat(args, media_fullname)
+            if (args.catalog.get(media_fullname, stat) is None
+                and args.catalog.probe_error(media_fullname, stat) is None
+                and not os.path.exists(video_info_name(args.thumbdir, media_fullname, sourcedir, key))):
+                videos.append((media_fullname, stat))
+    if not videos:
+        return
+    check_ffmpeg()
+
+    def probe(video):
+        # info or exception, and duration
+        media_fullname, stat = video
+        start = perf_counter()
+        try:
+            info = make_video_info(media_fullname, stat, *media_timestamp(args, media_fullname))
+        except (SubprocessError, ValueError, OSError) as exc:
+            # OSError: e.g. video removed since the scan
+            info = exc
+        return info, perf_counter() - start
+
+    import concurrent.futures
+    workers = min(len(videos), max(args.jobs, os.cpu_count() or 1))
+    t0 = perf_counter()
+    with build_phase(args, 'probe', len(videos)), \
+         concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+        for (media_fullname, stat), (info, duration) in zip(videos, executor.map(probe, videos)):
+            if isinstance(info, Exception):
+                args.catalog.put_probe_error(media_fullname, stat, str(info))
+                args.progress.item_done(media_fullname, duration, str(info))
+            else:
+                args.catalog.put(media_fullname, stat, info)
+                args.progress.item_done(media_fullname, duration)
+    elapsed = perf_counter() - t0
+    print(f'Video probe: {len(videos)} videos in {elapsed:.2f} s ({workers} concurrent ffprobe)')
+
+
 def format_video_info(date, time, width, height, size, duration, fps):
     return f'{date} {time}, dim={width}x{height}, {format_duration(duration)}, fps={fps}, {size} MB'
 
@@ -783,11 +1330,250 @@ def format_duration(duration):
         return f'h:m:s={hour:02}:{mn:02}:{sec:02}'
 
 
+# -- Media catalog ------------------------------------------------------------
+
+
+CATALOG_NAME = '.catalog.db'
+
+CATALOG_SCHEMA = '''\
+CREATE TABLE IF NOT EXISTS medias (
+    path TEXT PRIMARY KEY,
+    filesize INTEGER,
+    mtime INTEGER,
+    date TEXT,
+    time TEXT,
+    width INTEGER,
+    height INTEGER,
+    size REAL,
+    duration INTEGER,
+    fps REAL
+);
+CREATE TABLE IF NOT EXISTS probe_errors (
+    path TEXT PRIMARY KEY,
+    filesize INTEGER,
+    mtime INTEGER,
+    error TEXT
+);
+CREATE TABLE IF NOT EXISTS outputs (
+    name TEXT PRIMARY KEY,
+    signature TEXT
+);
+CREATE TABLE IF NOT EXISTS manifest (
+    name TEXT PRIMARY KEY,
+    hash TEXT
+);
+CREATE TABLE IF NOT EXISTS fingerprints (
+    path TEXT PRIMARY KEY,
+    filesize INTEGER,
+    mtime INTEGER,
+    fingerprint TEXT
+);
+CREATE TABLE IF NOT EXISTS fragments (
+    key TEXT PRIMARY KEY,
+    html TEXT
+);
+CREATE TABLE IF NOT EXISTS page_fragments (
+    page TEXT,
+    key TEXT
+);
+'''
+
+
+class MediaCatalog:
+    """
+    Persistent description of medias (date, time, dimensions, size, duration
+    and fps for videos) stored in the thumbnail directory. An entry is valid
+    as long as the size and the modification time of the media are unchanged.
+    Videos which cannot be probed are recorded the same way with the error.
+
+    The catalog also records the signature of the inputs of each output (html
+    pages and subdir thumbnails) to skip the outputs whose inputs are
+    unchanged, the manifest of written files with their content hash, and the
+    html fragments rendered from markdown texts with the pages using them.
+    """
+    def __init__(self, thumbdir):
+        self.dest = os.path.dirname(thumbdir)
+        self.filename = os.path.join(thumbdir, CATALOG_NAME)
+        self.connection = sqlite3.connect(self.filename)
+        self.connection.executescript(CATALOG_SCHEMA)
+        self.reset_counters()
+
+    def get(self, filename, stat):
+        row = self.connection.execute(
+            'SELECT date, time, width, height, size, duration, fps FROM medias '
+            'WHERE path = ? AND filesize = ? AND mtime = ?',
+            (filename, stat.st_size, stat.st_mtime_ns)).fetchone()
+        if row is None:
+            return None
+        elif row[5] is None:
+            # image
+            return row[:5]
+        else:
+            return row
+
+    def put(self, filename, stat, info):
+        # images have no duration and fps
+        info = tuple(info) + (None,) * (7 - len(info))
+        self.connection.execute(
+            'INSERT OR REPLACE INTO medias VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+            (filename, stat.st_size, stat.st_mtime_ns, *info))
+
+    def probe_error(self, filename, stat):
+        # error message if the probe of a video has failed, None otherwise
+        row = self.connection.execute(
+            'SELECT error FROM probe_errors WHERE path = ? AND filesize = ? AND mtime = ?',
+            (filename, stat.st_size, stat.st_mtime_ns)).fetchone()
+        return None if row is None else row[0]
+
+    def put_probe_error(self, filename, stat, error):
+        self.connection.execute(
+            'INSERT OR REPLACE INTO probe_errors VALUES (?, ?, ?, ?)',
+            (filename, stat.st_size, stat.st_mtime_ns, error))
+
+    def fingerprint(self, filename, stat):
+        """
+        Return the hash of the content of a media, computed once for given
+        size and modification time.
+        """
+        row = self.connection.execute(
+            'SELECT fingerprint FROM fingerprints WHERE path = ? AND filesize = ? AND mtime = ?',
+            (filename, stat.st_size, stat.st_mtime_ns)).fetchone()
+        if row:
+            return row[0]
+
+        hasher = hashlib.sha1()
+        with open(filename, 'rb') as f:
+            while chunk := f.read(1 << 20):
+                hasher.update(chunk)
+        fingerprint = hasher.hexdigest()
+        self.connection.execute(
+            'INSERT OR REPLACE INTO fingerprints VALUES (?, ?, ?, ?)',
+            (filename, stat.st_size, stat.st_mtime_ns, fingerprint))
+        return fingerprint
+
+    def is_uptodate(self, output, signature):
+        row = self.connection.execute(
+            'SELECT signature FROM outputs WHERE name = ?', (output,)).fetchone()
+        if row and row[0] == signature and os.path.exists(os.path.join(self.dest, output)):
+            self.skipped += 1
+            return True
+        else:
+            return False
+
+    def record_output(self, output, signature):
+        self.rebuilt += 1
+        self.connection.execute(
+            'INSERT OR REPLACE INTO outputs VALUES (?, ?)', (output, signature))
+
+    def file_hash(self, output):
+        row = self.connection.execute(
+            'SELECT hash FROM manifest WHERE name = ?', (output,)).fetchone()
+        return row[0] if row else None
+
+    def record_file(self, output, digest):
+        self.connection.execute(
+            'INSERT OR REPLACE INTO manifest VALUES (?, ?)', (output, digest))
+
+    def fragment(self, key):
+        self.fragment_keys.add(key)
+        row = self.connection.execute(
+            'SELECT html FROM fragments WHERE key = ?', (key,)).fetchone()
+        if row:
+            self.fragment_hits += 1
+            return row[0]
+        else:
+            self.fragment_misses += 1
+            return None
+
+    def record_fragment(self, key, html):
+        self.connection.execute(
+            'INSERT OR REPLACE INTO fragments VALUES (?, ?)', (key, html))
+
+    def record_page_fragments(self, page):
+        # the fragments looked up since the previous page are used by page
+        keys, self.fragment_keys = self.fragment_keys, set()
+        self.connection.execute('DELETE FROM page_fragments WHERE page = ?', (page,))
+        self.connection.executemany(
+            'INSERT INTO page_fragments VALUES (?, ?)', ((page, key) for key in keys))
+
+    def prune_fragments(self, pages):
+        """
+        Remove the fragments which are not used by pages, the html pages of the
+        gallery. Pages which are skipped keep the fragments recorded when they
+        were written.
+        """
+        used = {row[0] for row in self.connection.execute('SELECT DISTINCT page FROM page_fragments')}
+        self.connection.executemany(
+            'DELETE FROM page_fragments WHERE page = ?', ((page,) for page in used - pages))
+        self.connection.execute(
+            'DELETE FROM fragments WHERE key NOT IN (SELECT key FROM page_fragments)')
+
+    def manifest(self):
+        return {row[0] for row in self.connection.execute('SELECT name FROM manifest')}
+
+    def update_manifest(self, names):
+        previous = self.manifest()
+        self.connection.executemany(
+            'DELETE FROM manifest WHERE name = ?', ((name,) for name in previous - names))
+        self.connection.executemany(
+            'INSERT INTO manifest VALUES (?, NULL)', ((name,) for name in names - previous))
+
+    def report(self):
+        print(f'Outputs: {self.rebuilt} rebuilt, {self.skipped} skipped')
+        if lookups := self.fragment_hits + self.fragment_misses:
+            print(f'Markdown cache: {self.fragment_hits} hits, {self.fragment_misses} misses '
+                  f'({self.fragment_hits / lookups:.0%} hit rate)')
+
+    def reset_counters(self):
+        # counters are reported for each build in watch mode
+        self.rebuilt = 0
+        self.skipped = 0
+        self.fragment_hits = 0
+        self.fragment_misses = 0
+        self.fragment_keys = set()
+
+    def commit(self):
+        self.connection.commit()
+
+    def close(self):
+        self.connection.commit()
+        self.connection.close()
+
+
 # -- Thumbnails (image and video) ---------------------------------------------
 
 
-def thumbname(name, key):
-    return key + '-' + name + '.jpg'
+# thumbnail formats: Pillow format and file extension
+THUMBNAIL_FORMATS = {
+    'jpeg': ('JPEG', '.jpg'),
+    'webp': ('WEBP', '.webp'),
+    'avif': ('AVIF', '.avif'),
+}
+
+
+def thumbname(name, key, ext='.jpg'):
+    return key + '-' + name + ext
+
+
+def thumbnail_save_options(thumbnails):
+    """
+    Pillow save options given by the format settings of the configuration.
+    Default settings give the same files as Pillow defaults.
+    """
+    fmt, _ = THUMBNAIL_FORMATS[thumbnails.format]
+    options = dict(format=fmt, quality=thumbnails.quality)
+    if fmt == 'JPEG':
+        if thumbnails.optimize:
+            options['optimize'] = True
+        if thumbnails.progressive:
+            options['progressive'] = True
+    elif fmt == 'WEBP':
+        if thumbnails.optimize:
+            options['method'] = 6
+    elif fmt == 'AVIF':
+        if thumbnails.optimize:
+            options['speed'] = 2
+    return options
 
 
 def size_thumbnail(width, height, maxdim):
@@ -798,33 +1584,86 @@ def size_thumbnail(width, height, maxdim):
 
 
 def make_thumbnail_image(args, image_name, thumb_name, size):
-    if os.path.exists(thumb_name) and args.forcethumb is False:
+    if os.path.exists(thumb_name) and args.forcethumb is False and image_name not in args.modified:
+        pass
+    elif shared_thumbnail(args, image_name, thumb_name, ('image', size, args.thumbnails.thumbmode,
+                                                          sorted(args.saveoptions.items()))):
         pass
     else:
-        print('Making thumbnail:', thumb_name)
-        create_thumbnail_image(image_name, thumb_name, size)
+        args.progress.queued('thumbnail', thumb_name)
+        # all thumbnails of an image are made from a single decoding
+        thumbs = args.imagethumbs[os.path.normpath(image_name)]
+        if (thumb_name, size) not in thumbs:
+            thumbs.append((thumb_name, size))
 
 
-def create_thumbnail_image(image_name, thumb_name, size):
-    imgobj = Image.open(image_name)
+def hidpi_name(thumb_name):
+    # name of the thumbnail at double resolution
+    root, ext = os.path.splitext(thumb_name)
+    return root + '@2x' + ext
+
 
-    if (imgobj.mode != 'RGBA'
-        and image_name.endswith('.jpg')
-        and not (image_name.endswith('.gif') and imgobj.info.get('transparency'))
-       ):
-        imgobj = imgobj.convert('RGBA')
+def create_thumbnail_image(image_name, thumbs, thumbmode='quality', save_options=None):
+    """
+    Make the thumbnails of an image given as a list of (name, size) with a
+    single decoding.
+
+    With thumbmode 'speed', JPEG images are decoded at a reduced scale (DCT
+    scaling to the nearest power of two above twice the largest thumbnail
+    size) and no conversion is made at full resolution.
+    """
+    from PIL import Image
+    imgobj = Image.open(image_name)
 
-    imgobj.thumbnail(size, Image.LANCZOS)
-    imgobj = imgobj.convert('RGB')
-    imgobj.save(thumb_name)
+    if thumbmode == 'speed':
+        if imgobj.format == 'JPEG':
+            width = max(size[0] for _, size in thumbs)
+            height = max(size[1] for _, size in thumbs)
+            imgobj.draft('RGB', (width * 2, height * 2))
+        options = dict(reducing_gap=2.0)
+    else:
+        if (imgobj.mode != 'RGBA'
+            and image_name.endswith('.jpg')
+            and not (image_name.endswith('.gif') and imgobj.info.get('transparency'))
+           ):
+            imgobj = imgobj.convert('RGBA')
+        options = dict()
+
+    for thumb_name, size in thumbs:
+        thumbobj = imgobj.copy() if len(thumbs) > 1 else imgobj
+        thumbobj.thumbnail(size, Image.LANCZOS, **options)
+        if thumbobj.mode != 'RGB':
+            thumbobj = thumbobj.convert('RGB')
+        save_thumbnail(thumbobj, thumb_name, save_options)
+
+
+def save_thumbnail(img, thumb_name, save_options=None):
+    """
+    Save a thumbnail to a temporary file renamed to thumb_name. Thumbnails may
+    be hard links to the files of the shared cache, which must not be written
+    in place.
+    """
+    from PIL import Image
+    options = dict(save_options or dict())
+    if 'format' not in options:
+        options['format'] = Image.registered_extensions()[os.path.splitext(thumb_name)[1].lower()]
+    tmpname = f'{thumb_name}.{os.getpid()}.tmp'
+    img.save(tmpname, **options)
+    os.replace(tmpname, thumb_name)
 
 
 def make_thumbnail_video(args, video_name, thumb_name, size, duration):
-    if os.path.exists(thumb_name) and args.forcethumb is False:
+    delay = max(0, min(duration - 1, args.thumbnails.thumbdelay))
+    if os.path.exists(thumb_name) and args.forcethumb is False and video_name not in args.modified:
+        pass
+    elif shared_thumbnail(args, video_name, thumb_name, ('video', size, delay,
+                                                         sorted(args.saveoptions.items()))):
         pass
     else:
-        print('Making thumbnail:', thumb_name)
-        create_thumbnail_video(args, video_name, thumb_name, size, duration)
+        args.progress.queued('thumbnail', thumb_name)
+        check_ffmpeg()
+        submit_thumbnail(args, create_thumbnail_video, video_name, thumb_name, size, duration,
+                         args.thumbnails.thumbdelay, args.saveoptions)
 
 
 # base64 video.png
@@ -837,31 +1676,57 @@ PxqDcH6p1swXBC4l6yZskACkTN1WrQr2SlIFhTtgqeZa+zsOogLXegvEocZ5c/W5BcoVNNCg3hSudV
 TkSuQmCC'''
 
 
-def create_thumbnail_video(args, filename, thumbname, size:(int, int), duration):
+# seconds
+FFMPEG_TIMEOUT = 60
+
+
+def create_thumbnail_video(filename, thumbname, size:(int, int), duration, thumbdelay, save_options=None):
+    # return False when the thumbnail is replaced by the invalid icon
+    from PIL import Image
     # ffmpeg must be in path
-    delay = min(duration - 1, args.thumbnails.thumbdelay)
-    sizearg = '%dx%d' % size
-    command = 'ffmpeg -y -v error -itsoffset -%d -i "%s" -vcodec mjpeg -vframes 1 -an -f rawvideo -s %s "%s"'
-    command = command % (delay, filename, sizearg, thumbname)
-    result = os.system(command)
-
-    # test if newly created thumbnail open, otherwise something wrong with video
-    # and replace thumbnail with invalid icon
-    try:
-        img1 = Image.open(thumbname)
-    except:
-        # ffmpeg was unable to save thumbnail
-        warning('Unable to save thumbnail for', filename)
+    img1 = extract_video_frame(filename, size, max(0, min(duration - 1, thumbdelay)))
+    valid = img1 is not None
+    if not valid:
+        # something wrong with video, replace thumbnail with invalid icon
         img1 = create_thumbnail_invalid()
 
     # add a movie icon to the thumbnail to identify videos
     img2 = Image.open(io.BytesIO(base64.b64decode(VIDEO_ICON)))
     width, height = img1.size
     img1.paste(img2, (6, height - 20 - 6), None)
-    img1.save(thumbname)
+    save_thumbnail(img1, thumbname, save_options)
+    return valid
+
+
+def extract_video_frame(filename, size, delay):
+    """
+    Return the frame at delay seconds of a video, scaled to size, as an image
+    object, or None in case of error. Seeking is done before opening the input
+    (fast seek on key frames) and the frame is read from the output of ffmpeg
+    as raw RGB data.
+    """
+    from PIL import Image
+    command = [
+        'ffmpeg', '-v', 'error', '-ss', str(delay), '-i', filename,
+        '-an', '-frames:v', '1', '-s', '%dx%d' % size,
+        '-f', 'rawvideo', '-pix_fmt', 'rgb24', '-'
+    ]
+    try:
+        result = run_subprocess(command, stdout=PIPE, stderr=PIPE, timeout=FFMPEG_TIMEOUT)
+    except (OSError, SubprocessError) as exc:
+        warning(str(exc))
+        return None
+
+    if result.returncode != 0 or len(result.stdout) != size[0] * size[1] * 3:
+        if result.stderr:
+            warning(result.stderr.decode(errors='replace').strip())
+        return None
+
+    return Image.frombytes('RGB', size, result.stdout)
 
 
 def create_thumbnail_invalid():
+    from PIL import Image, ImageDraw
     WHITE = (255, 255, 255)
     RED = "#ff0000"
     myImage = Image.new('RGB', (300, 200), WHITE)
@@ -874,13 +1739,28 @@ def create_thumbnail_invalid():
 
 
 def make_thumbnail_subdir(args, subdir_name, thumb_name, size, items, thumbdir):
-    # subdir thumbnails are always created as they depend on the content of the
-    # directory
-    print('Making thumbnail:', thumb_name)
-    create_thumbnail_subdir(subdir_name, thumb_name, size, items, thumbdir)
+    # requires the thumbnails of the items, made by run_thumbnail_jobs, which
+    # may then skip the mosaic (see make_mosaic)
+    args.mosaicjobs.append((subdir_name, thumb_name, size, items, thumbdir, args.saveoptions))
+
+
+def make_mosaic(args, subdir_name, thumb_name, size, items, thumbdir, save_options):
+    """
+    Make a subdir thumbnail unless the fingerprint of the thumbnails it is made
+    from is unchanged. Return True if made.
+    """
+    fingerprint = mosaic_fingerprint(size, items, thumbdir, save_options)
+    output = relative_output(args, thumb_name)
+    if args.forcethumb is False and args.catalog.is_uptodate(output, fingerprint):
+        return False
+    args.progress.queued('thumbnail', thumb_name)
+    create_thumbnail_subdir(subdir_name, thumb_name, size, items, thumbdir, save_options)
+    args.catalog.record_output(output, fingerprint)
+    return True
 
 
-def create_thumbnail_subdir(subdir_name, thumb_name, size, items, thumbdir):
+def create_thumbnail_subdir(subdir_name, thumb_name, size, items, thumbdir, save_options=None):
+    from PIL import Image
 
     def size_thumbnail(width, height, xmax, ymax):
         width2 = xmax
@@ -906,21 +1786,240 @@ def create_thumbnail_subdir(subdir_name, thumb_name, size, items, thumbdir):
         img2 = img2.crop(cropdim)
         img.paste(img2, (offsetx[col], offsety[row]))
 
-    if os.path.exists(thumb_name):
-        # test if the generated thumbnail is identical to the one already on disk
-        imgref = Image.open(thumb_name)
+    save_thumbnail(img, thumb_name, save_options)
 
-        # must save and reload before comparing
-        byteio = io.BytesIO()
-        img.save(byteio, "JPEG")
-        byteio.seek(0)
-        imgnew = Image.open(byteio)
 
-        diff = ImageChops.difference(imgnew, imgref)
-        if diff.getbbox() is None:
-            return
+def shared_thumbnail(args, media_fullname, thumb_name, params):
+    """
+    Get a thumbnail from the shared cache where thumbnails are stored by
+    content fingerprint of the media and rendering parameters. Return True if
+    found. Otherwise the thumbnail will be stored in the cache once made.
+    """
+    if not args.thumbnails.shared_cache:
+        return False
+
+    stat = media_stat(args, media_fullname)
+    key = signature(args.catalog.fingerprint(media_fullname, stat), params)
+    cache_name = os.path.join(args.thumbnails.shared_cache, key[:2], key + os.path.splitext(thumb_name)[1])
+
+    if os.path.exists(cache_name) and args.forcethumb is False:
+        link_or_copy(cache_name, thumb_name)
+        args.sharedstats['reused'] += 1
+        return True
+    else:
+        args.cachestores.append((thumb_name, cache_name))
+        return False
+
+
+def store_shared_thumbnails(args, failed=()):
+    # failed thumbnails (e.g. invalid icon of videos) are not shared
+    for thumb_name, cache_name in args.cachestores:
+        if os.path.exists(thumb_name) and thumb_name not in failed:
+            os.makedirs(os.path.dirname(cache_name), exist_ok=True)
+            link_or_copy(thumb_name, cache_name)
+            args.sharedstats['stored'] += 1
+    args.cachestores = []
+    if args.thumbnails.shared_cache:
+        print('Shared cache: {reused} thumbnails reused, {stored} stored'.format(**args.sharedstats))
+
+
+def link_or_copy(src, dst):
+    tmpname = f'{dst}.{os.getpid()}.tmp'
+    try:
+        os.link(src, tmpname)
+    except OSError:
+        shutil.copyfile(src, tmpname)
+    os.replace(tmpname, dst)
 
-    img.save(thumb_name)
+
+def submit_thumbnail(args, func, *params):
+    """
+    Keep a thumbnail to be made by run_thumbnail_jobs.
+    """
+    args.thumbjobs.append((func, params))
+
+
+def run_thumbnail_job(job, counted=False):
+    """
+    Executed in worker processes when using several jobs. Errors are returned
+    rather than raised to enable the other jobs to complete, as well as the
+    thumbnails made incomplete (create functions returning False). The
+    duration of the job is returned for progress events and, when counted is
+    true, its io counters for profiling.
+    """
+    func, params = job
+    counters = io_counters() if counted else None
+    t0 = perf_counter()
+    try:
+        if func(*params) is False:
+            msg = f'Unable to make thumbnail for {params[0]}'
+        else:
+            msg = None
+    except Exception as exc:
+        msg = f'Unable to make thumbnail for {params[0]} ({exc})'
+    duration = perf_counter() - t0
+    if counted:
+        counters = [now - then for now, then in zip(io_counters(), counters)]
+    return msg, duration, counters
+
+
+def job_thumbnails(job):
+    # names of the thumbnails made by a job of run_thumbnail_jobs
+    func, params = job
+    if func is create_thumbnail_image:
+        return [thumb_name for thumb_name, _ in params[1]]
+    else:
+        return [params[1]]
+
+
+def execute_thumbnail_jobs(args, jobs):
+    """
+    Iterate on the results of run_thumbnail_job for jobs, in a pool of worker
+    processes when using several jobs.
+    """
+    # io of workers is not seen by the profiler of the main process
+    counted = args.profiler.enabled and args.jobs > 1
+    if args.jobs == 1:
+        for job in jobs:
+            yield run_thumbnail_job(job)
+    elif jobs:
+        import concurrent.futures
+        import functools
+        chunksize = max(1, len(jobs) // (args.jobs * 8))
+        with concurrent.futures.ProcessPoolExecutor(max_workers=args.jobs) as executor:
+            yield from executor.map(functools.partial(run_thumbnail_job, counted=counted),
+                                    jobs, chunksize=chunksize)
+
+
+def run_thumbnail_jobs(args):
+    """
+    Make image and video thumbnails, in a pool of worker processes when using
+    several jobs, then subdir thumbnails and sprites which are made from the
+    previous ones.
+    """
+    image_jobs = [(create_thumbnail_image, (image_name, thumbs, args.thumbnails.thumbmode, args.saveoptions))
+                  for image_name, thumbs in args.imagethumbs.items()]
+    video_jobs = args.thumbjobs
+    made = [name for _, thumbs in args.imagethumbs.items() for name, _ in thumbs]
+    made.extend(params[1] for _, params in args.thumbjobs)
+    args.imagethumbs.clear()
+    args.thumbjobs = []
+
+    failed = set()
+    for phase, jobs in (('image thumbnails', image_jobs), ('video thumbnails', video_jobs)):
+        with build_phase(args, phase, len(jobs)):
+            for job, (msg, duration, counters) in zip(jobs, execute_thumbnail_jobs(args, jobs)):
+                _, params = job
+                if msg:
+                    warning(msg)
+                    failed.update(job_thumbnails(job))
+                if counters:
+                    args.profiler.add(phase, counters)
+                args.progress.item_done(params[0], duration, msg)
+
+    store_shared_thumbnails(args, failed)
+
+    # subdir thumbnails are recorded after the ones of their subdirs
+    mosaics, args.mosaicjobs = args.mosaicjobs, []
+    with build_phase(args, 'mosaics', len(mosaics)):
+        for params in mosaics:
+            t0 = perf_counter()
+            if make_mosaic(args, *params):
+                made.append(params[1])
+            args.progress.item_done(params[1], perf_counter() - t0)
+    report_format_migration(args, made)
+
+    sprites, args.spritejobs = args.spritejobs, []
+    with build_phase(args, 'sprites', len(sprites)):
+        for params in sprites:
+            t0 = perf_counter()
+            update_sprite(args, *params)
+            args.progress.item_done(params[0], perf_counter() - t0)
+
+
+class LazyThumbnails:
+    """
+    Thumbnail jobs run on first request of one of their thumbnails when the
+    gallery is served. A job is run once, concurrent requests for its
+    thumbnails wait for its completion. Jobs of subdir thumbnails and sprites
+    first make the thumbnails they are made from.
+    """
+    def __init__(self, cachestores):
+        self.jobs = list()
+        self.index = dict()
+        self.locks = dict()
+        self.lock = threading.Lock()
+        self.done = set()
+        self.cachestores = dict(cachestores)
+
+    def add(self, thumb_names, job, dependencies=()):
+        for thumb_name in thumb_names:
+            self.index[os.path.normpath(thumb_name)] = len(self.jobs)
+        self.jobs.append((job, thumb_names, dependencies))
+
+    def make(self, thumb_name):
+        # return False when thumb_name is not made by a job
+        index = self.index.get(os.path.normpath(thumb_name))
+        if index is None:
+            return False
+        with self.lock:
+            lock = self.locks.setdefault(index, threading.Lock())
+        with lock:
+            if index not in self.done:
+                job, thumb_names, dependencies = self.jobs[index]
+                for dependency in dependencies:
+                    self.make(dependency)
+                msg, _, _ = run_thumbnail_job(job)
+                if msg:
+                    warning(msg)
+                for name in thumb_names:
+                    if name in self.cachestores and os.path.exists(name) and not msg:
+                        os.makedirs(os.path.dirname(self.cachestores[name]), exist_ok=True)
+                        link_or_copy(name, self.cachestores[name])
+                self.done.add(index)
+        return True
+
+
+def lazy_thumbnail_jobs(args):
+    """
+    Return the pending thumbnail jobs indexed by the names of the thumbnails
+    they make, to be run on request when serving the gallery.
+    """
+    lazy = LazyThumbnails(args.cachestores)
+    for image_name, thumbs in args.imagethumbs.items():
+        lazy.add([name for name, _ in thumbs],
+                 (create_thumbnail_image, (image_name, thumbs, args.thumbnails.thumbmode, args.saveoptions)))
+    for func, params in args.thumbjobs:
+        lazy.add([params[1]], (func, params))
+    for params in args.mosaicjobs:
+        subdir_name, thumb_name, size, items, thumbdir, save_options = params
+        lazy.add([thumb_name], (create_thumbnail_subdir, params),
+                 [os.path.join(thumbdir, os.path.basename(item.thumb)) for item in items])
+    for params in args.spritejobs:
+        sprite_name, size, thumbs, save_options = params
+        lazy.add([sprite_name], (create_sprite, params), [name for name, _, _ in thumbs])
+
+    args.imagethumbs.clear()
+    args.thumbjobs = []
+    args.mosaicjobs = []
+    args.spritejobs = []
+    args.cachestores = []
+    print(f'Thumbnails: {len(lazy.jobs)} jobs made on request')
+    return lazy
+
+
+def report_format_migration(args, thumb_names):
+    # size saved by the thumbnails replacing thumbnails in another format
+    converted, saved = 0, 0
+    for thumb_name in thumb_names:
+        root, ext = os.path.splitext(thumb_name)
+        for _, other_ext in THUMBNAIL_FORMATS.values():
+            if other_ext != ext and os.path.exists(root + other_ext) and os.path.exists(thumb_name):
+                converted += 1
+                saved += os.path.getsize(root + other_ext) - os.path.getsize(thumb_name)
+    if converted:
+        print(f'Thumbnail format: {converted} thumbnails converted to {args.thumbnails.format}, '
+              f'{saved / 1e6:.1f} MB saved')
 
 
 def mosaic_geometry(size, thumblist):
@@ -960,20 +2059,101 @@ def mosaic_geometry(size, thumblist):
     return widthnum, heightnum, width, height, offsetx, offsety
 
 
+# -- Sprites ------------------------------------------------------------------
+
+
+SPRITE_COLUMNS = 10
+
+
+def sprites_enabled(args):
+    # sprites replace the thumbnails of the dcim blocks of the static grid
+    return args.thumbnails.sprites and args.thumbnails.grid == 'static'
+
+
+def make_sprites(args, posts):
+    """
+    Pack the thumbnails of each dcim block of posts, and of the pages of
+    subdirectories, into a sprite image.
+    """
+    for post in posts:
+        subdirs, dcim = dispatch_post_items(post.dcim)
+        if dcim:
+            make_sprite(args, dcim)
+        for item in subdirs:
+            make_sprites(args, item.posts)
+
+
+def make_sprite(args, items):
+    # thumbnails are placed in cells of the size of the largest one, the sprite
+    # is named after the first thumbnail and made when its thumbnails have
+    # changed (see update_sprite)
+    cellwidth = max(item.thumbsize[0] for item in items)
+    cellheight = max(item.thumbsize[1] for item in items)
+    sprite_basename = 'sprite-' + os.path.basename(items[0].thumb)
+    sprite_name = os.path.join(args.thumbdir, sprite_basename)
+
+    thumbs = list()
+    for index, item in enumerate(items):
+        x = index % SPRITE_COLUMNS * cellwidth
+        y = index // SPRITE_COLUMNS * cellheight
+        item.sprite = ('/'.join((args.thumbrep, sprite_basename)), x, y)
+        thumbs.append((os.path.join(args.thumbdir, os.path.basename(item.thumb)), x, y))
+    size = (min(len(items), SPRITE_COLUMNS) * cellwidth,
+            (len(items) + SPRITE_COLUMNS - 1) // SPRITE_COLUMNS * cellheight)
+
+    # requires the thumbnails of the items, made by run_thumbnail_jobs
+    args.spritejobs.append((sprite_name, size, thumbs, args.saveoptions))
+
+
+def update_sprite(args, sprite_name, size, thumbs, save_options):
+    """
+    Make a sprite unless the fingerprint of its thumbnails is unchanged. The
+    fingerprint is recorded only when all thumbnails have been read, to make
+    the sprite again at next build otherwise. Return True if made.
+    """
+    fingerprint = sprite_fingerprint(size, thumbs, save_options)
+    output = relative_output(args, sprite_name)
+    if args.forcethumb is False and args.catalog.is_uptodate(output, fingerprint):
+        return False
+    args.progress.queued('sprite', sprite_name)
+    if create_sprite(sprite_name, size, thumbs, save_options):
+        args.catalog.record_output(output, fingerprint)
+    return True
+
+
+def create_sprite(sprite_name, size, thumbs, save_options=None):
+    # return False if some thumbnail cannot be read (blank cell)
+    from PIL import Image
+    img = Image.new('RGB', size, 'white')
+    complete = True
+    for thumb_name, x, y in thumbs:
+        try:
+            with Image.open(thumb_name) as thumb:
+                img.paste(thumb, (x, y))
+        except OSError:
+            warning('Unable to read thumbnail', thumb_name)
+            complete = False
+    save_thumbnail(img, sprite_name, save_options)
+    return complete
+
+
+# -- Purge --------------------------------------------------------------------
+
+
 def list_of_htmlfiles(args, posts):
     htmlist = list()
-    htmlist.append(os.path.join(args.dest, args.rootname))
+    htmlist.extend(name for name, _, _ in html_pages(args, posts, os.path.join(args.dest, args.rootname)))
     for post in posts:
-        htmlist.extend(list_of_htmlfiles_in_items(post.dcim))
+        htmlist.extend(list_of_htmlfiles_in_items(args, post.dcim))
     return htmlist
 
 
-def list_of_htmlfiles_in_items(itemlist):
+def list_of_htmlfiles_in_items(args, itemlist):
     htmlist = list()
     for item in itemlist:
         if type(item) == PostSubdir:
-            htmlist.append(item.htmname)
-            htmlist.extend(list_of_htmlfiles_in_items(item.sublist))
+            htmlist.extend(name for name, _, _ in html_pages(args, item.posts, item.htmname))
+            htmlist.extend(list_of_htmlfiles_in_items(args, item.sublist))
     return htmlist
 
 
@@ -994,18 +2174,84 @@ def list_of_thumbnails_in_items(itemlist):
             thumblist.extend(list_of_thumbnails_in_items(item.sublist))
         else:
             thumblist.append(os.path.basename(item.thumb))
+            if item.thumb2x:
+                thumblist.append(os.path.basename(item.thumb2x))
+            if item.sprite:
+                thumblist.append(os.path.basename(item.sprite[0]))
     return thumblist
 
 
-def purge_htmlfiles(args, posts):
+# extensions of files in the thumbnail directory which may be purged (.info files
+# are made by versions before the catalog, .json files are data of virtual grids)
+THUMBNAIL_EXTENSIONS = ('.jpg', '.webp', '.avif', '.info', '.json')
+
+
+def is_html_output(name):
+    return not name.startswith('.') and fnmatch.fnmatch(name, '*.htm*')
+
+
+def is_thumbnail_output(name):
+    return not name.startswith('.') and os.path.splitext(name)[1] in THUMBNAIL_EXTENSIONS
+
+
+def purge_outputs(args, posts):
+    """
+    Purge html files and thumbnails not produced by the current build, then
+    replace the manifest of the previous build with the current one.
+    """
+    diary = bool(args.diary and not args.sourcedir)
+    htmlfiles = {relative_output(args, name) for name in list_of_htmlfiles(args, posts)}
+    thumbnails = {args.thumbrep + '/' + name for name in list_of_thumbnails(posts, diary)}
+    if args.thumbnails.grid == 'virtual':
+        thumbnails.update(args.thumbrep + '/' + os.path.basename(grid_data_name(args, name))
+                          for name in htmlfiles)
+    html_orphans, thumb_orphans = orphan_outputs(args, htmlfiles, thumbnails)
+
+    if args.purge_report:
+        purge_report(args, html_orphans | thumb_orphans)
+    else:
+        if args.thumbnails.enable_purge in ('all', 'html'):
+            purge_htmlfiles(args, html_orphans)
+        if args.thumbnails.enable_purge in ('all', 'thumb'):
+            purge_thumbnails(args, thumb_orphans)
+
+    args.catalog.update_manifest(htmlfiles | thumbnails)
+    args.catalog.prune_fragments(htmlfiles)
+
+
+def orphan_outputs(args, htmlfiles, thumbnails):
+    """
+    Return the sets of html files and thumbnails to purge (names relative to
+    destination). Candidates are the files of the previous manifest and, to
+    catch files made before the manifest, the files with an html or thumbnail
+    extension in the gallery directories.
+    """
+    with os.scandir(args.dest) as entries:
+        html = {entry.name for entry in entries if entry.is_file()}
+    with os.scandir(args.thumbdir) as entries:
+        thumbs = {entry.name for entry in entries if entry.is_file()}
+    previous = args.catalog.manifest()
+
+    html_candidates = {name for name in html if is_html_output(name)} | (previous & html)
+    thumbs = {args.thumbrep + '/' + name: is_thumbnail_output(name) for name in thumbs}
+    thumb_candidates = {name for name, isthumb in thumbs.items() if isthumb} | (previous & thumbs.keys())
+    return html_candidates - htmlfiles, thumb_candidates - thumbnails
+
+
+def purge_report(args, orphans):
+    total = 0
+    for name in sorted(orphans):
+        size = os.path.getsize(os.path.join(args.dest, name))
+        total += size
+        print(f'{size:>12} {name}')
+    print(f'Purge report: {len(orphans)} files to remove, {total / 1e6:.1f} MB to free')
+
+
+def purge_htmlfiles(args, html_orphans):
     """
     Purge root dir from irrelevant html files
     """
-    htmlist = list_of_htmlfiles(args, posts)
-    html_to_remove = list()
-    for fullname in glob.glob(os.path.join(args.root, '*.htm*')):
-        if fullname not in htmlist:
-            html_to_remove.append(fullname)
+    html_to_remove = [os.path.join(args.dest, name) for name in sorted(html_orphans)]
 
     if len(html_to_remove) > args.thumbnails.threshold_htmlfiles:
         inpt = 'x'
@@ -1019,15 +2265,11 @@ def purge_htmlfiles(args, posts):
         os.remove(name)
 
 
-def purge_thumbnails(args, thumbdir, posts, diary=False):
+def purge_thumbnails(args, thumb_orphans):
     """
     Purge thumbnail dir from irrelevant thumbnails
     """
-    thumblist = list_of_thumbnails(posts, diary)
-    thumbs_to_remove = list()
-    for fullname in glob.glob(os.path.join(thumbdir, '*.jpg')):
-        if os.path.basename(fullname) not in thumblist:
-            thumbs_to_remove.append(fullname)
+    thumbs_to_remove = [os.path.join(args.dest, name) for name in sorted(thumb_orphans)]
 
     if len(thumbs_to_remove) > args.thumbnails.threshold_thumbs:
         inpt = 'x'
@@ -1043,18 +2285,15 @@ def purge_thumbnails(args, thumbdir, posts, diary=False):
     for name in thumbs_to_remove:
         print('Removing thumbnail', name)
         os.remove(name)
-        info_fullname = os.path.splitext(name)[0] + '.info'
-        if os.path.exists(info_fullname):
-            os.remove(info_fullname)
 
 
 # -- List of medias helpers ---------------------------------------------------
 
 
-def is_media_within_dates(fullname, dates):
+def is_media_within_dates(args, fullname):
     if is_media(fullname):
-        if type(dates) == tuple:
-            return dates[0] <= date_from_item(fullname) <= dates[1]
+        if type(args.dates) == tuple:
+            return args.dates[0] <= media_timestamp(args, fullname)[0] <= args.dates[1]
         else:
             return True
     else:
@@ -1078,21 +2317,142 @@ def sorted_listdir(filelist):
     return sorted(filelist, key=keyfunc)
 
 
-def list_of_files(sourcedir, recursive):
+class SourceDir:
     """
-    Return the list of full paths for files in source directory
+    Content of a source directory. Subdirectories and file entries are kept in
+    listing order.
     """
-    result = list()
-    if recursive is False:
-        listdir = sorted_listdir(os.listdir(sourcedir))
-        if '.nomedia' not in listdir:
-            for basename in listdir:
-                result.append(os.path.join(sourcedir, basename))
+    def __init__(self, path, islink):
+        self.path = path
+        self.islink = islink
+        self.nomedia = False
+        self.subdirs = dict()
+        self.files = dict()
+        self.within_dates = dict()
+        self.has_media = None
+
+
+class SourceTree:
+    """
+    In-memory model of a source directory tree made with a single scan. Stat
+    data of files is requested to the DirEntry objects and kept.
+    """
+    def __init__(self, root):
+        self.root = root
+        self.nodes = dict()
+        self.stats = dict()
+        self.fscalls = 0
+        self.visited = set()
+        self.scan(root, islink=False)
+
+    def scan(self, path, islink, previous=None):
+        # subdirectories already in previous node are not scanned again
+        node = SourceDir(path, islink)
+        self.nodes[path] = node
+        self.visited.add(os.path.realpath(path))
+        self.fscalls += 1
+        try:
+            with os.scandir(path) as it:
+                entries = list(it)
+        except OSError:
+            entries = []
+        for entry in entries:
+            if entry.is_dir():
+                if previous is not None and entry.name in previous.subdirs:
+                    node.subdirs[entry.name] = previous.subdirs[entry.name]
+                elif entry.is_symlink() and os.path.realpath(entry.path) in self.visited:
+                    continue
+                else:
+                    node.subdirs[entry.name] = self.scan(entry.path, entry.is_symlink())
+            else:
+                node.files[entry.name] = entry
+        node.nomedia = '.nomedia' in node.files
+        return node
+
+    def rescan(self, path):
+        """
+        Update the node of a directory whose content has changed. Known
+        subdirectories are kept, new ones are scanned and removed ones are
+        forgotten. Ancestors will check again whether they contain medias.
+        """
+        previous = self.nodes[path]
+        for basename in previous.files:
+            self.stats.pop(os.path.join(path, basename), None)
+        node = self.scan(path, previous.islink, previous)
+        for basename, subdir in previous.subdirs.items():
+            if basename not in node.subdirs:
+                self.forget(subdir)
+
+        parent = self.nodes.get(os.path.dirname(path))
+        if parent is not None and parent.subdirs.get(os.path.basename(path)) is previous:
+            parent.subdirs[os.path.basename(path)] = node
+        while parent is not None:
+            parent.has_media = None
+            parent = self.nodes.get(os.path.dirname(parent.path)) if parent.path != self.root else None
+
+    def forget(self, node):
+        self.nodes.pop(node.path, None)
+        for subdir in node.subdirs.values():
+            self.forget(subdir)
+
+    def stat(self, fullname):
+        if fullname not in self.stats:
+            dirname, basename = os.path.split(fullname)
+            self.fscalls += 1
+            try:
+                self.stats[fullname] = self.nodes[dirname].files[basename].stat()
+            except KeyError:
+                self.stats[fullname] = os.stat(fullname)
+        return self.stats[fullname]
+
+    def walk(self, node):
+        # same order as os.walk, symbolic links followed only at top level
+        yield node
+        for subdir in node.subdirs.values():
+            if not subdir.islink:
+                yield from self.walk(subdir)
+
+    def report(self):
+        nfiles = sum(len(node.files) for node in self.nodes.values())
+        print(f'Source tree: {len(self.nodes)} directories, {nfiles} files, '
+              f'{self.fscalls} filesystem calls')
+
+
+def source_node(args, dirname):
+    """
+    Return the node of the source tree for dirname. The tree is scanned on
+    first request.
+    """
+    if args.sourcetree is None or dirname not in args.sourcetree.nodes:
+        with build_phase(args, 'scan'):
+            args.sourcetree = SourceTree(dirname)
+    return args.sourcetree.nodes[dirname]
+
+
+def is_source_subdir(args, fullname):
+    return args.sourcetree is not None and fullname in args.sourcetree.nodes
+
+
+def media_stat(args, fullname):
+    if args.sourcetree is None:
+        return os.stat(fullname)
     else:
-        for root, dirs, files in os.walk(sourcedir):
-            if '.nomedia' not in files:
-                for basename in sorted_listdir(files):
-                    result.append(os.path.join(root, basename))
+        return args.sourcetree.stat(fullname)
+
+
+def medias_of_node(args, node):
+    """
+    Return the list of full paths for pictures and movies in a node, with
+    cached date filtering.
+    """
+    result = list()
+    if not node.nomedia:
+        for basename in sorted_listdir(list(node.files)):
+            fullname = os.path.join(node.path, basename)
+            if basename not in node.within_dates:
+                node.within_dates[basename] = is_media_within_dates(args, fullname)
+            if node.within_dates[basename]:
+                result.append(fullname)
     return result
 
 
@@ -1100,8 +2460,12 @@ def list_of_medias(args, sourcedir, recursive):
     """
     Return the list of full paths for pictures and movies in source directory
     """
-    files = list_of_files(sourcedir, recursive)
-    return [_ for _ in files if is_media_within_dates(_, args.dates)]
+    node = source_node(args, sourcedir)
+    if recursive is False:
+        return medias_of_node(args, node)
+    else:
+        return [media for subnode in args.sourcetree.walk(node)
+                      for media in medias_of_node(args, subnode)]
 
 
 def list_of_medias_ext(args, sourcedir):
@@ -1109,27 +2473,25 @@ def list_of_medias_ext(args, sourcedir):
     Return the list of full paths for pictures and movies in source directory
     plus subdirectories containing media
     """
+    node = source_node(args, sourcedir)
     result = list()
-    listdir = sorted_listdir(os.listdir(sourcedir))
-    if '.nomedia' not in listdir:
-        for basename in listdir:
+    if not node.nomedia:
+        medias = set(medias_of_node(args, node))
+        for basename in sorted_listdir(list(node.subdirs) + list(node.files)):
             fullname = os.path.join(sourcedir, basename)
-            if os.path.isdir(fullname) and basename != '$RECYCLE.BIN' and contains_media(args, fullname):
-                result.append(fullname)
-            else:
-                if is_media_within_dates(fullname, args.dates):
+            if basename in node.subdirs:
+                if basename != '$RECYCLE.BIN' and contains_media(args, node.subdirs[basename]):
                     result.append(fullname)
+            elif fullname in medias:
+                result.append(fullname)
     return result
 
 
-def contains_media(args, dirname):
-    for root, dirs, files in os.walk(dirname):
-        if '.nomedia' not in files:
-            for basename in files:
-                if is_media_within_dates(os.path.join(root, basename), args.dates):
-                    return True
-    else:
-        return False
+def contains_media(args, node):
+    if node.has_media is None:
+        node.has_media = any(medias_of_node(args, subnode)
+                             for subnode in args.sourcetree.walk(node))
+    return node.has_media
 
 
 def dispatch_post_items(list_of_post_items):
@@ -1142,28 +2504,36 @@ def dispatch_post_items(list_of_post_items):
 
 
 def create_item(args, media_fullname, sourcedir, thumbdir, key, thumbmax):
-    if os.path.isfile(media_fullname):
-        if is_image_file(media_fullname):
-            return create_item_image(args, media_fullname, sourcedir, thumbdir, key, thumbmax)
-        else:
-            return create_item_video(args, media_fullname, sourcedir, thumbdir, key, thumbmax)
-    else:
+    if is_source_subdir(args, media_fullname):
         return create_item_subdir(args, media_fullname, sourcedir, thumbdir, key, thumbmax)
+    elif is_image_file(media_fullname):
+        return create_item_image(args, media_fullname, sourcedir, thumbdir, key, thumbmax)
+    else:
+        return create_item_video(args, media_fullname, sourcedir, thumbdir, key, thumbmax)
 
 
 def create_item_image(args, media_fullname, sourcedir, thumbdir, key, thumbmax):
+    import PIL
     media_basename = os.path.basename(media_fullname)
     media_relname = relative_name(media_fullname, sourcedir)
-    thumb_basename = thumbname(media_relname, key)
+    thumb_basename = thumbname(media_relname, key, args.thumbext)
     thumb_fullname = os.path.join(thumbdir, thumb_basename)
 
     try:
-        info, infofmt = get_image_info(media_fullname)
+        info, infofmt = get_image_info(args, media_fullname)
         infofmt = media_basename + ': ' + infofmt
         thumbsize = size_thumbnail(info[2], info[3], thumbmax)
         make_thumbnail_image(args, media_fullname, thumb_fullname, thumbsize)
-        return PostImage(None, media_fullname, '/'.join((args.thumbrep, thumb_basename)),
+        item = PostImage(None, media_fullname, '/'.join((args.thumbrep, thumb_basename)),
                          thumbsize, infofmt)
+        item.date, item.time = info[:2]
+        # no hidpi thumbnail for the items drawn from a sprite
+        hidpi = args.thumbnails.hidpi and not (key == 'dcim' and sprites_enabled(args))
+        if hidpi and max(info[2], info[3]) >= 2 * thumbmax:
+            item.thumbsize2x = size_thumbnail(info[2], info[3], 2 * thumbmax)
+            item.thumb2x = hidpi_name(item.thumb)
+            make_thumbnail_image(args, media_fullname, hidpi_name(thumb_fullname), item.thumbsize2x)
+        return item
     except PIL.UnidentifiedImageError:
         # corrupted image
         warning('Unable to read image', media_fullname)
@@ -1173,18 +2543,20 @@ def create_item_image(args, media_fullname, sourcedir, thumbdir, key, thumbmax):
 def create_item_video(args, media_fullname, sourcedir, thumbdir, key, thumbmax):
     media_basename = os.path.basename(media_fullname)
     media_relname = relative_name(media_fullname, sourcedir)
-    thumb_basename = thumbname(media_relname, key)
+    thumb_basename = thumbname(media_relname, key, args.thumbext)
     thumb_fullname = os.path.join(thumbdir, thumb_basename)
-    info_fullname = os.path.splitext(thumb_fullname)[0] + '.info'
+    info_fullname = video_info_name(thumbdir, media_fullname, sourcedir, key)
 
     try:
-        info, infofmt = get_video_info(media_fullname, info_fullname)
+        info, infofmt = get_video_info(args, media_fullname, info_fullname)
         infofmt = media_basename + ': ' + infofmt
         thumbsize = size_thumbnail(info[2], info[3], thumbmax)
         make_thumbnail_video(args, media_fullname, thumb_fullname, thumbsize, duration=info[5])
-        return PostVideo(None, media_fullname, '/'.join((args.thumbrep, thumb_basename)),
+        item = PostVideo(None, media_fullname, '/'.join((args.thumbrep, thumb_basename)),
                          thumbsize, infofmt)
-    except CalledProcessError:
+        item.date, item.time = info[:2]
+        return item
+    except (SubprocessError, ValueError):
         # corrupted video
         warning('Unable to read video', media_fullname)
         return None
@@ -1193,7 +2565,7 @@ def create_item_video(args, media_fullname, sourcedir, thumbdir, key, thumbmax):
 def create_item_subdir(args, media_fullname, sourcedir, thumbdir, key, thumbmax):
     media_basename = os.path.basename(media_fullname)
     media_relname = relative_name(media_fullname, sourcedir)
-    thumb_basename = thumbname(media_relname, key)
+    thumb_basename = thumbname(media_relname, key, args.thumbext)
     thumb_fullname = os.path.join(thumbdir, thumb_basename)
 
     info, infofmt = None, None
@@ -1257,12 +2629,17 @@ def make_posts_from_diary(args):
     else:
         error('File not found', md_filename)
 
+    medias = [os.path.join(args.root, media.uri) for post in posts for media in post.medias]
+    probe_videos(args, medias, args.root, 'post')
+
     for post in posts:
         for media in post.medias:
             media_fullname = os.path.join(args.root, media.uri)
             item = create_item(args, media_fullname, args.root, args.thumbdir, 'post', 400)
             media.thumb = item.thumb
             media.thumbsize = item.thumbsize
+            media.thumb2x = item.thumb2x
+            media.thumbsize2x = item.thumbsize2x
             media.descr = item.descr
 
     return title, posts
@@ -1273,21 +2650,24 @@ def create_items_by_date(args, medias, posts):
     if args.dates == 'diary':
         required_dates = {post.date for post in posts}
     else:
-        required_dates = {date_from_item(media) for media in medias}
+        required_dates = {media_timestamp(args, media)[0] for media in medias}
         if type(args.dates) == tuple:
             date1, date2 = args.dates
             required_dates = {date for date in required_dates if date1 <= date <= date2}
 
+    medias = [media for media in medias if media_timestamp(args, media)[0] in required_dates]
+    probe_videos(args, medias, args.sourcedir, 'dcim')
+
     bydate = defaultdict(list)
     for media_fullname in medias:
-        date = date_from_item(media_fullname)
+        date, _ = media_timestamp(args, media_fullname)
         if date in required_dates:
             item = create_item(args, media_fullname, args.sourcedir, args.thumbdir, 'dcim', 300)
             if item:
                 bydate[date].append(item)
 
     for date, liste in bydate.items():
-        liste.sort(key=lambda item: time_from_item(item.uri))
+        liste.sort(key=lambda item: item.time)
 
     return bydate
 
@@ -1332,6 +2712,7 @@ def make_posts_from_subdir(args, dirname):
     #        medias_ext_bis.append(media)
 
     # complete posts
+    probe_videos(args, medias_ext, args.sourcedir, 'dcim')
     postmedias = list()
     for item in medias_ext:
         postmedia = create_item(args, item, args.sourcedir, args.thumbdir, 'dcim', 300)
@@ -1380,19 +2761,465 @@ def make_posts_from_subdir_and_date(args, dirname):
     return title, posts
 
 
+# -- Profiling ----------------------------------------------------------------
+
+
+PROFILE_NAME = 'galerie-profile.json'
+CPROFILE_NAME = 'galerie-profile.prof'
+PROFILE_COUNTERS = ('read', 'written', 'subprocesses')
+
+SUBPROCESSES = 0
+SUBPROCESSES_LOCK = threading.Lock()
+
+
+def run_subprocess(command, **kwargs):
+    # subprocess.run counting the subprocesses spawned, for profiling
+    global SUBPROCESSES
+    with SUBPROCESSES_LOCK:
+        SUBPROCESSES += 1
+    return run(command, **kwargs)
+
+
+def io_counters():
+    """
+    Return bytes read and written by the process (read from /proc, zero when
+    not available) and number of subprocesses spawned.
+    """
+    read, written = 0, 0
+    try:
+        with open('/proc/self/io') as f:
+            for line in f:
+                key, value = line.split(':')
+                if key == 'rchar':
+                    read = int(value)
+                elif key == 'wchar':
+                    written = int(value)
+    except OSError:
+        pass
+    return read, written, SUBPROCESSES
+
+
+class Profiler:
+    """
+    Time, number of calls and io counters of the phases of a build. Time is
+    exclusive: the time spent in a phase nested in another one is given to the
+    nested phase only. When requested, each phase is also profiled with
+    cProfile. Nothing is done when the profiler is not enabled.
+    """
+    def __init__(self, enabled=False, cprofile=False):
+        self.enabled = enabled
+        self.cprofile = cprofile
+        self.phases = dict()
+        self.profiles = dict()
+        self.stack = list()
+        self.start = perf_counter()
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        if not self.enabled:
+            yield
+            return
+        if self.stack:
+            self.suspend(self.stack[-1])
+        self.stats(name)['calls'] += 1
+        self.stack.append([name, None, None])
+        self.resume(self.stack[-1])
+        try:
+            yield
+        finally:
+            self.suspend(self.stack.pop())
+            if self.stack:
+                self.resume(self.stack[-1])
+
+    def stats(self, name):
+        if name not in self.phases:
+            self.phases[name] = dict(time=0.0, calls=0, **{key: 0 for key in PROFILE_COUNTERS})
+        return self.phases[name]
+
+    def resume(self, entry):
+        entry[1:] = perf_counter(), io_counters()
+        if self.cprofile:
+            import cProfile
+            self.profiles.setdefault(entry[0], cProfile.Profile()).enable()
+
+    def suspend(self, entry):
+        if self.cprofile:
+            self.profiles[entry[0]].disable()
+        name, start, counters = entry
+        self.stats(name)['time'] += perf_counter() - start
+        self.add(name, [now - then for now, then in zip(io_counters(), counters)])
+
+    def add(self, name, counters):
+        # counters: list of increments in the order of PROFILE_COUNTERS
+        stats = self.stats(name)
+        for key, value in zip(PROFILE_COUNTERS, counters):
+            stats[key] += value
+
+    def report(self, dest):
+        """
+        Print the summary table and write it as json in the dest directory
+        with, when requested, the cProfile stats of the slowest phase.
+        """
+        if not self.enabled:
+            return
+        total = perf_counter() - self.start
+        phases = dict(self.phases)
+        other = self.stats('other')
+        other['time'] = total - sum(stats['time'] for stats in phases.values())
+        phases['other'] = other
+
+        print('Profile:')
+        print(f'    {"phase":<18}{"time (s)":>10}{"%":>7}{"calls":>8}'
+              f'{"read (MB)":>11}{"written (MB)":>14}{"subprocesses":>14}')
+        for name, stats in phases.items():
+            print(f'    {name:<18}{stats["time"]:>10.2f}{100 * stats["time"] / total:>7.1f}'
+                  f'{stats["calls"]:>8}{stats["read"] / 1e6:>11.1f}{stats["written"] / 1e6:>14.1f}'
+                  f'{stats["subprocesses"]:>14}')
+        print(f'    {"total":<18}{total:>10.2f}')
+
+        report = dict(total=total, phases=phases)
+        if self.cprofile and self.profiles:
+            slowest = max(self.profiles, key=lambda name: phases[name]['time'])
+            self.profiles[slowest].dump_stats(os.path.join(dest, CPROFILE_NAME))
+            report['cprofile'] = dict(phase=slowest, filename=CPROFILE_NAME)
+            print(f'cProfile stats of phase "{slowest}" written to {CPROFILE_NAME}')
+        with open(os.path.join(dest, PROFILE_NAME), 'wt') as f:
+            json.dump(report, f, indent=4)
+
+
+# -- Progress events ----------------------------------------------------------
+
+
+class Progress:
+    """
+    Stream of progress events given as json lines: start and end of phases,
+    items queued and items done with their duration, the throughput of the
+    phase and the time to complete the items of the phase. Nothing is emitted
+    without stream and the messages on queued items are printed instead.
+    """
+    def __init__(self, stream=None):
+        self.stream = stream
+        self.start = perf_counter()
+        self.current = None
+
+    @property
+    def enabled(self):
+        return self.stream is not None
+
+    def emit(self, event, **fields):
+        if self.stream is None:
+            return
+        record = dict(event=event,
+                      time=datetime.datetime.now().isoformat(timespec='milliseconds'),
+                      elapsed=round(perf_counter() - self.start, 3),
+                      **fields)
+        try:
+            self.stream.write(json.dumps(record) + '\n')
+            self.stream.flush()
+        except OSError:
+            # the build goes on when nobody listens anymore
+            self.stream = None
+
+    @contextlib.contextmanager
+    def phase(self, name, total=0):
+        # current phase: name, number of items, number of items done, start
+        previous = self.current
+        self.current = [name, total, 0, perf_counter()]
+        self.emit('phase_start', phase=name, total=total)
+        try:
+            yield
+        finally:
+            name, _, done, start = self.current
+            self.emit('phase_end', phase=name, done=done, duration=round(perf_counter() - start, 3))
+            self.current = previous
+
+    def queued(self, kind, name):
+        if self.stream is None:
+            print(f'Making {kind}:', name)
+        else:
+            self.emit('item_queued', kind=kind, item=name)
+
+    def item_done(self, name, duration, error=None):
+        if self.stream is None:
+            return
+        self.current[2] += 1
+        phase, total, done, start = self.current
+        elapsed = perf_counter() - start
+        throughput = done / elapsed if elapsed > 0 else None
+        eta = (total - done) / throughput if throughput and total >= done else None
+        fields = dict(phase=phase, item=name, duration=round(duration, 3), done=done, total=total,
+                      throughput=throughput and round(throughput, 2), eta=eta and round(eta, 1))
+        if error:
+            fields['error'] = error
+        self.emit('item_done', **fields)
+
+
+@contextlib.contextmanager
+def build_phase(args, name, total=0):
+    # phase of the build, profiled and reported in progress events
+    with args.profiler.phase(name), args.progress.phase(name, total):
+        yield
+
+
+def progress_stream(progress):
+    """
+    Return the stream of progress events for the value of --progress: stderr
+    or the number of an open file descriptor.
+    """
+    if progress is None:
+        return None
+    elif progress == 'stderr':
+        return sys.stderr
+    elif progress.isdigit():
+        try:
+            return os.fdopen(int(progress), 'w', buffering=1, closefd=False)
+        except OSError:
+            pass
+    error('Incorrect parameters:', '--progress must be stderr or an open file descriptor')
+
+
 # -- Creation of html page from directory tree --------------------------------
 
 
 def create_gallery(args):
+    args.catalog = MediaCatalog(args.thumbdir)
+    args.sourcetree = None
+    args.timestamps = dict()
+    args.modified = set()
+    try:
+        build_gallery(args)
+        if args.serve:
+            _, thread = serve_gallery(args)
+        if args.watch:
+            watch_gallery(args)
+        elif args.serve:
+            thread.join()
+    finally:
+        args.catalog.close()
+
+
+def build_gallery(args):
+    args.imagethumbs = defaultdict(list)
+    args.thumbjobs = []
+    args.mosaicjobs = []
+    args.spritejobs = []
+    args.cachestores = []
+    args.sharedstats = dict(reused=0, stored=0)
+    args.catalog.reset_counters()
+
     title, posts = make_posts(args, args.sourcedir)
-    print_html(args, posts, title, os.path.join(args.dest, args.rootname), 'regular')
-    if args.thumbnails.enable_purge in ('all', 'html'):
-        purge_htmlfiles(args, posts)
-    if args.thumbnails.enable_purge in ('all', 'thumb'):
-        if args.diary and not args.sourcedir:
-            purge_thumbnails(args, args.thumbdir, posts, diary=True)
+    if sprites_enabled(args):
+        make_sprites(args, posts)
+    if args.serve:
+        args.lazythumbs = lazy_thumbnail_jobs(args)
+    else:
+        run_thumbnail_jobs(args)
+    with build_phase(args, 'html'):
+        print_html(args, posts, title, os.path.join(args.dest, args.rootname), 'regular')
+        print_subdir_pages(args, posts)
+    if args.sourcetree:
+        args.sourcetree.report()
+    args.catalog.report()
+    with build_phase(args, 'purge'):
+        purge_outputs(args, posts)
+    args.catalog.commit()
+    args.profiler.report(args.dest)
+
+
+# -- Preview server -----------------------------------------------------------
+
+
+def serve_gallery(args):
+    """
+    Serve the destination directory on localhost in a background thread and
+    return the server and the thread. Missing thumbnails are made on first request and kept
+    on disk.
+    """
+    import http.server
+    import functools
+
+    class RequestHandler(http.server.SimpleHTTPRequestHandler):
+        def send_head(self):
+            # used for GET and HEAD requests
+            path = self.translate_path(self.path)
+            if not os.path.exists(path):
+                args.lazythumbs.make(path)
+            return super().send_head()
+
+        def log_message(self, format, *params):
+            pass
+
+    handler = functools.partial(RequestHandler, directory=args.dest)
+    try:
+        server = http.server.ThreadingHTTPServer(('127.0.0.1', args.serve), handler)
+    except OSError as exc:
+        error('Unable to serve gallery', str(exc))
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    print(f'Serving gallery at http://127.0.0.1:{args.serve}/{args.rootname}, Ctrl-C to stop')
+    return server, thread
+
+
+# -- Watch mode ---------------------------------------------------------------
+
+
+# files other than medias whose changes update the gallery
+WATCHED_FILES = ('.nomedia', 'index.md')
+
+
+class SourceWatcher:
+    """
+    Detection of changes in the directories of the source. Directories are
+    listed with the size and modification time of their entries, a directory
+    has changed when its listing differs from the previous one. Without
+    inotify (module inotify_simple), all directories are listed at each poll.
+    With inotify, only the directories with events are.
+
+    New directories are listed from the entries of the source tree, i.e. as
+    seen by the next build, and are listed again at the next poll: files added
+    while the gallery is built, before the directory is watched, are detected.
+    """
+    def __init__(self, args, interval):
+        self.args = args
+        self.interval = interval
+        self.listings = dict()
+        self.watches = dict()
+        self.pending = set()
+        self.inotify = None
+        try:
+            import inotify_simple
+            self.inotify = inotify_simple.INotify()
+            flags = inotify_simple.flags
+            self.mask = (flags.CREATE | flags.DELETE | flags.MODIFY | flags.CLOSE_WRITE
+                         | flags.MOVED_FROM | flags.MOVED_TO | flags.ATTRIB)
+        except (ImportError, OSError):
+            pass
+        self.update()
+
+    def directories(self):
+        # directories of the source tree and root directory (diary)
+        directories = set(self.args.sourcetree.nodes) if self.args.sourcetree else set()
+        directories.add(self.args.root)
+        directories.discard(self.args.thumbdir)
+        return directories
+
+    def update(self):
+        # list new directories and forget removed ones
+        directories = self.directories()
+        for dirname in directories - self.listings.keys():
+            self.listings[dirname] = self.tree_listing(dirname)
+            self.pending.add(dirname)
+            if self.inotify:
+                try:
+                    self.watches[self.inotify.add_watch(dirname, self.mask)] = dirname
+                except OSError:
+                    pass
+        for dirname in self.listings.keys() - directories:
+            del self.listings[dirname]
+            self.pending.discard(dirname)
+            for wd in [wd for wd, name in self.watches.items() if name == dirname]:
+                del self.watches[wd]
+                try:
+                    self.inotify.rm_watch(wd)
+                except OSError:
+                    pass
+
+    def listing(self, dirname):
+        result = dict()
+        try:
+            with os.scandir(dirname) as it:
+                for entry in it:
+                    if entry.is_dir():
+                        if entry.path != self.args.thumbdir:
+                            result[entry.name] = None
+                    elif is_media(entry.name) or entry.name in WATCHED_FILES:
+                        stat = entry.stat()
+                        result[entry.name] = stat.st_size, stat.st_mtime_ns
+        except OSError:
+            pass
+        return result
+
+    def tree_listing(self, dirname):
+        # same as listing from the entries kept by the source tree
+        node = self.args.sourcetree.nodes.get(dirname) if self.args.sourcetree else None
+        if node is None:
+            return self.listing(dirname)
+        result = {name: None for name, subdir in node.subdirs.items() if subdir.path != self.args.thumbdir}
+        for name, entry in node.files.items():
+            if is_media(name) or name in WATCHED_FILES:
+                try:
+                    stat = entry.stat()
+                except OSError:
+                    continue
+                result[name] = stat.st_size, stat.st_mtime_ns
+        return result
+
+    def poll(self):
+        """
+        Wait for an interval and return the set of directories whose listing
+        has changed and the set of files modified in place.
+        """
+        if self.inotify:
+            events = self.inotify.read(timeout=int(self.interval * 1000))
+            candidates = {self.watches[event.wd] for event in events if event.wd in self.watches}
         else:
-            purge_thumbnails(args, args.thumbdir, posts)
+            sleep(self.interval)
+            candidates = set(self.listings)
+        candidates |= self.pending
+        self.pending = set()
+        changed, modified = set(), set()
+        for dirname in candidates:
+            listing = self.listing(dirname)
+            previous = self.listings[dirname]
+            if listing != previous:
+                self.listings[dirname] = listing
+                changed.add(dirname)
+                modified.update(os.path.join(dirname, name) for name, state in listing.items()
+                                if state is not None and previous.get(name, state) != state)
+        return changed, modified
+
+    def wait(self):
+        """
+        Return the sets of changed directories and modified files when changes
+        have been detected and no other change occurs during an interval
+        (bursts of changes, e.g. when copying medias, are debounced).
+        """
+        changed, modified = set(), set()
+        while True:
+            directories, files = self.poll()
+            if directories:
+                changed |= directories
+                modified |= files
+            elif changed:
+                return changed, modified
+
+
+def update_source_tree(args, changed):
+    # parents first to skip the removed directories
+    for dirname in sorted(changed):
+        if args.sourcetree is not None and dirname in args.sourcetree.nodes:
+            args.sourcetree.rescan(dirname)
+    for filename in [name for name in args.timestamps if os.path.dirname(name) in changed]:
+        del args.timestamps[filename]
+
+
+def watch_gallery(args):
+    """
+    Update the gallery when the source changes. Source tree and catalog are
+    kept between updates: only changed directories are listed again, only new
+    or modified medias are described and thumbnailed, and only the pages whose
+    inputs have changed are rendered again.
+    """
+    watcher = SourceWatcher(args, args.watch)
+    method = 'inotify' if watcher.inotify else f'polling every {args.watch} s'
+    print(f'Watching {len(watcher.listings)} directories ({method}), Ctrl-C to stop')
+    while True:
+        changed, args.modified = watcher.wait()
+        print(f'Changes in {len(changed)} directories, updating gallery')
+        update_source_tree(args, changed)
+        watcher.update()
+        args.profiler = Profiler(args.profiler.enabled, args.profiler.cprofile)
+        build_gallery(args)
 
 
 # -- Creation of diary from medias --------------------------------------------
@@ -1400,13 +3227,15 @@ def create_gallery(args):
 
 def create_diary(args):
     # list of all pictures and movies
+    args.sourcetree = None
+    args.timestamps = dict()
     medias = list_of_medias(args, args.sourcedir, args.recursive)
 
     # list of required dates
     if args.dates == 'diary':
         assert 0
     else:
-        required_dates = {date_from_item(media) for media in medias}
+        required_dates = {media_timestamp(args, media)[0] for media in medias}
         if type(args.dates) == tuple:
             date1, date2 = args.dates
             required_dates = {date for date in required_dates if date1 <= date <= date2}
@@ -1471,6 +3300,12 @@ github_pages = false
 ; value: true or false
 daily_anchors = false
 
+; split html pages with dated posts into an index page and a page per month,
+; per year or per number of days (only the pages of modified dates are
+; rewritten)
+; value: none, month, year or number of days
+paginate = none
+
 [thumbnails]
 
 ; specifies whether or not the gallery displays media description (size, dimension, etc)
@@ -1485,6 +3320,53 @@ subdir_caption = true
 ; value: number of seconds
 thumbdelay = 5
 
+; thumbnail creation for images: best quality or faster with reduced decoding of
+; JPEG images
+; value: quality or speed
+thumbmode = quality
+
+; rendering of thumbnails: static html or virtual grid (thumbnails are read from
+; a json file and rendered when visible, pages must be served over http)
+; value: static or virtual
+grid = static
+
+; pack the thumbnails of each day into a sprite image to reduce the number of
+; requests (static grid only, the sprite is used instead of hidpi thumbnails)
+; value: true or false
+sprites = false
+
+; file format of thumbnails (avif requires a version of Pillow supporting it),
+; thumbnails are renamed and made again when changing format
+; value: jpeg, webp or avif
+format = jpeg
+
+; quality of thumbnails (use --forcethumb to apply a new value to existing
+; thumbnails)
+; value: integer from 0 to 100
+quality = 75
+
+; progressive jpeg thumbnails
+; value: true or false
+progressive = false
+
+; smaller thumbnails with slower encoding
+; value: true or false
+optimize = false
+
+; make image thumbnails also at double resolution for high density screens
+; (srcset attribute)
+; value: true or false
+hidpi = false
+
+; directory of a thumbnail cache shared by several galleries (thumbnails are
+; linked or copied from it)
+; value: valid path or empty (no shared cache)
+shared_cache =
+
+; number of processes used to make thumbnails (may be given with --jobs)
+; value: integer (1 = no parallelism)
+jobs = 1
+
 ; maximum number of thumbnails to remove without user confirmation
 ; value: integer
 threshold_thumbs = 10
@@ -1599,11 +3481,22 @@ def getconfig(options, config_filename):
     options.source.github_pages = config.getboolean('source', 'github_pages', default=False)
     options.source.daily_anchors = config.getboolean('source', 'daily_anchors', default=False)
     options.source.local_map = config.getboolean('source', 'local_map', default=False)
+    options.source.paginate = config.get('source', 'paginate', fallback='none')
 
     # [thumbnails]
     options.thumbnails.media_description = config.getboolean('thumbnails', 'media_description')
     options.thumbnails.subdir_caption = config.getboolean('thumbnails', 'subdir_caption')
     options.thumbnails.thumbdelay = config.getint('thumbnails', 'thumbdelay')
+    options.thumbnails.thumbmode = config.get('thumbnails', 'thumbmode', fallback='quality')
+    options.thumbnails.grid = config.get('thumbnails', 'grid', fallback='static')
+    options.thumbnails.sprites = config.getboolean('thumbnails', 'sprites', default=False)
+    options.thumbnails.hidpi = config.getboolean('thumbnails', 'hidpi', default=False)
+    options.thumbnails.format = config.get('thumbnails', 'format', fallback='jpeg')
+    options.thumbnails.quality = config.getint('thumbnails', 'quality', default=75)
+    options.thumbnails.progressive = config.getboolean('thumbnails', 'progressive', default=False)
+    options.thumbnails.optimize = config.getboolean('thumbnails', 'optimize', default=False)
+    options.thumbnails.jobs = config.getint('thumbnails', 'jobs', default=1)
+    options.thumbnails.shared_cache = config.get('thumbnails', 'shared_cache', fallback='')
     options.thumbnails.threshold_thumbs = config.getint('thumbnails', 'threshold_thumbs')
     options.thumbnails.threshold_htmlfiles = config.getint('thumbnails', 'threshold_htmlfiles', default=3)
     options.thumbnails.enable_purge = config.get('thumbnails', 'enable_purge', fallback='all')
@@ -1682,6 +3575,7 @@ Error creating configuration file
 Error reading configuration file.
 Incorrect date format
 Incorrect parameters:
+Unable to serve gallery
 '''
 
 
@@ -1744,6 +3638,22 @@ def parse_command_line(argstring):
                         action='store_true', default=False)
     agroup.add_argument('--enable_purge', help='enable purge of thumbnails and html files',
                         action='store', default='all', choices=('none', 'thumb', 'html', 'all'))
+    agroup.add_argument('--jobs', help='number of processes used to make thumbnails',
+                        action='store', default=None, type=int, metavar='<n>')
+    agroup.add_argument('--purge_report', '--purge-report',
+                        help='list the files to purge instead of removing them',
+                        action='store_true', default=False)
+    agroup.add_argument('--profile', help='report time and io of each phase of the gallery build',
+                        action='store', nargs='?', default=None, const='summary',
+                        choices=('summary', 'cprofile'))
+    agroup.add_argument('--progress', help='emit progress events as json lines on stderr or a file descriptor',
+                        action='store', default=None, metavar='stderr|<fd>')
+    agroup.add_argument('--watch', help='update the gallery when the source changes',
+                        action='store', nargs='?', default=None, const=2.0, type=float,
+                        metavar='<seconds>')
+    agroup.add_argument('--serve', help='serve the gallery on localhost, thumbnails made on request',
+                        action='store', nargs='?', default=None, const=8000, type=int,
+                        metavar='<port>')
 
     if not argstring:
        parser.print_help()
@@ -1802,7 +3712,6 @@ def setup_part1(args):
 def setup_part2(args):
     """
     Made after reading config file.
-    Check for ffmpeg in path.
     Create .thumbnails dir if necessary and create .nomedia in it.
     Copy photobox file to destination dir.
     Handle priority between command line and config file.
@@ -1856,6 +3765,45 @@ def setup_part2(args):
         if args.gallery and args.diary is False and args.update is None:
             error('Directory not found', 'Use --sourcedir')
 
+    if args.thumbnails.thumbmode not in ('quality', 'speed'):
+        error('Missing or incorrect config value:', '[thumbnails]thumbmode')
+
+    if args.thumbnails.grid not in ('static', 'virtual'):
+        error('Missing or incorrect config value:', '[thumbnails]grid')
+
+    if args.thumbnails.format not in THUMBNAIL_FORMATS:
+        error('Missing or incorrect config value:', '[thumbnails]format')
+    if args.thumbnails.format != 'jpeg':
+        from PIL import Image
+        Image.init()
+        if THUMBNAIL_FORMATS[args.thumbnails.format][0] not in Image.SAVE:
+            error('Missing or incorrect config value:', '[thumbnails]format', '(not supported by Pillow)')
+    if not 0 <= args.thumbnails.quality <= 100:
+        error('Missing or incorrect config value:', '[thumbnails]quality')
+    args.thumbext = THUMBNAIL_FORMATS[args.thumbnails.format][1]
+    args.saveoptions = thumbnail_save_options(args.thumbnails)
+
+    if args.source.paginate in ('none', 'month', 'year'):
+        args.paginate = None if args.source.paginate == 'none' else args.source.paginate
+    elif args.source.paginate.isdigit() and int(args.source.paginate) > 0:
+        args.paginate = int(args.source.paginate)
+    else:
+        error('Missing or incorrect config value:', '[source]paginate')
+
+    if args.thumbnails.shared_cache:
+        shared_cache = os.path.expanduser(args.thumbnails.shared_cache)
+        args.thumbnails.shared_cache = os.path.join(args.root, shared_cache)
+
+    args.profiler = Profiler(args.profile is not None, args.profile == 'cprofile')
+    args.progress = Progress(progress_stream(args.progress))
+
+    if args.jobs is None:
+        args.jobs = args.thumbnails.jobs
+    if args.jobs < 1:
+        error('Incorrect parameters:', '--jobs must be at least 1')
+    if args.watch is not None and args.watch <= 0:
+        error('Incorrect parameters:', '--watch interval must be positive')
+
     if args.dest:
         args.dest = os.path.abspath(args.dest)
 
@@ -1863,13 +3811,6 @@ def setup_part2(args):
         args.dest = args.root
 
     if args.gallery or args.update:
-        # check for ffmpeg and ffprobe in path
-        for exe in ('ffmpeg', 'ffprobe'):
-            try:
-                check_output([exe, '-version'])
-            except FileNotFoundError:
-                error('File not found', exe)
-
         if args.github_pages:
             args.thumbrep = 'thumbnails'
         else:
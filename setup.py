@@ -30,10 +30,11 @@ setup(
        ('Lib/site-packages/galerie/photobox', glob.glob('galerie/photobox/*.*')),
     ] + test_files,
     install_requires = [
-        'clipboard',
         'pillow',
-        'lxml',
         'colorama',
         'markdown'
-    ]
+    ],
+    extras_require = {
+        'watch': ['inotify_simple'],
+    }
 )
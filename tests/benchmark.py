@@ -0,0 +1,360 @@
+"""
+Benchmarks for galerie.py
+
+benchmark.py thumbnails [scale]
+    compares the quality and speed modes of image thumbnail creation on the
+    test images, optionally enlarged by scale (e.g. 6 to get 12 MP images)
+
+benchmark.py diary [size]
+    parses generated diary files of size/4, size/2 and size MB (default 50)
+    to check that parsing time is linear in the size of the diary
+
+benchmark.py startup
+    times the import of galerie and a command without medias in a new
+    interpreter, compared to the interpreter alone
+
+benchmark.py gallery [photos=<n>] [videos=<n>] [resolution=<w>x<h>]
+                     [depth=<n>] [diary=<n>] [modes=<mode,...>]
+                     [output=<file.json>]
+    generates a synthetic tree of medias (photos and videos with dates in
+    names, in directories nested depth times, diary of given number of
+    posts), then builds a gallery in each mode (bydate, bydir, diary,
+    recursive) cold (empty gallery) and warm (same command again). Wall
+    time, peak RSS and number of files touched in the gallery are printed
+    and saved as json (default benchmark-gallery.json) to compare runs.
+    Videos require ffmpeg.
+"""
+
+
+import os
+import sys
+import glob
+import time
+import datetime
+import shutil
+import tempfile
+import io
+import subprocess
+import json
+import platform
+
+from PIL import Image
+
+import galerie
+
+
+# -- Helpers ------------------------------------------------------------------
+
+
+def timeit(func, *params, repeat=3):
+    """
+    Return the best time of several executions.
+    """
+    best = None
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        func(*params)
+        elapsed = time.perf_counter() - t0
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def test_images(tmpdir, scale):
+    """
+    Return the list of test images, enlarged in tmpdir if scale > 1.
+    """
+    images = sorted(glob.glob('OCT_*.jpg'))
+    if scale == 1:
+        return images
+
+    result = list()
+    for image in images:
+        imgobj = Image.open(image)
+        width, height = imgobj.size
+        imgobj = imgobj.resize((width * scale, height * scale), Image.LANCZOS)
+        fullname = os.path.join(tmpdir, image)
+        imgobj.save(fullname, quality=90)
+        result.append(fullname)
+    return result
+
+
+def test_diary(filename, size):
+    """
+    Write a diary of about size bytes, with short records and some records of
+    thousands of lines.
+    """
+    date = datetime.date(2000, 1, 1)
+    written = 0
+    with open(filename, 'wt', encoding='utf-8') as f:
+        f.write('# Diary\n\n')
+        for index in range(sys.maxsize):
+            if written >= size:
+                break
+            nlines = 2000 if index % 100 == 0 else 5
+            lines = [f'[{date:%Y/%m/%d}]\n', '\n', f'### Post {index}\n', '\n']
+            lines.extend('Lorem ipsum dolor sit amet, consectetur adipiscing elit.\n' for _ in range(nlines))
+            lines.append('\n')
+            lines.extend(f'![](OCT_{date:%Y%m%d}_{rank:06}.jpg)\ncaption\n' for rank in range(3))
+            lines.append('______\n')
+            record = ''.join(lines)
+            f.write(record)
+            written += len(record)
+            date += datetime.timedelta(days=1)
+
+
+def synthetic_tree(root, photos, videos, resolution, depth, diary):
+    """
+    Generate a tree of medias in root: photos and videos named after their
+    date and time (four medias per day), spread over directories nested depth
+    times (two subdirectories per level), and a diary (index.md) with the
+    given number of posts illustrated by the photos.
+    """
+    dirs = level_dirs = ['']
+    for level in range(depth):
+        level_dirs = [os.path.join(parent, f'dir{level}{index}') for parent in level_dirs for index in range(2)]
+        dirs = dirs + level_dirs
+    for dirname in dirs:
+        os.makedirs(os.path.join(root, dirname), exist_ok=True)
+
+    # a few base images (noise compresses and decodes like photos), copied under media names
+    width, height = (int(x) for x in resolution.split('x'))
+    bases = list()
+    for index in range(3):
+        channels = [Image.effect_noise((width, height), 32 + 16 * index) for _ in range(3)]
+        byteio = io.BytesIO()
+        Image.merge('RGB', channels).save(byteio, 'JPEG', quality=90)
+        bases.append(byteio.getvalue())
+
+    base_video = None
+    if videos:
+        base_video = os.path.join(root, 'base.tmp')
+        subprocess.run(['ffmpeg', '-v', 'error', '-f', 'lavfi', '-i', 'testsrc=duration=10:size=640x360:rate=25',
+                        '-pix_fmt', 'yuv420p', '-f', 'mp4', base_video], check=True)
+
+    start = datetime.datetime(2000, 1, 1, 10)
+    medias = [('OCT_%s.jpg', index) for index in range(photos)]
+    medias.extend(('VID_%s.mp4', index * photos // max(videos, 1)) for index in range(videos))
+    medias.sort(key=lambda media: media[1])
+    photonames = list()
+    for rank, (pattern, _) in enumerate(medias):
+        timestamp = start + datetime.timedelta(days=rank // 4, minutes=rank % 4)
+        name = os.path.join(dirs[rank % len(dirs)], pattern % f'{timestamp:%Y%m%d_%H%M%S}')
+        if name.endswith('.jpg'):
+            with open(os.path.join(root, name), 'wb') as f:
+                f.write(bases[rank % len(bases)])
+            photonames.append((timestamp, name))
+        else:
+            shutil.copyfile(base_video, os.path.join(root, name))
+    if base_video:
+        os.remove(base_video)
+
+    with open(os.path.join(root, 'index.md'), 'wt', encoding='utf-8') as f:
+        f.write('# Diary\n\n')
+        for index in range(diary):
+            timestamp, name = photonames[index % len(photonames)] if photonames else (start, None)
+            f.write(f'[{timestamp:%Y/%m/%d}]\n\n### Post {index}\n\n')
+            f.write('Lorem ipsum dolor sit amet, consectetur adipiscing elit.\n\n')
+            if name:
+                f.write(f'![]({name.replace(os.sep, "/")})\n')
+            f.write('______\n')
+
+    return len(dirs)
+
+
+def snapshot(dirname):
+    """
+    Return the modification times of the files of a directory tree.
+    """
+    result = dict()
+    for path, _, files in os.walk(dirname):
+        for name in files:
+            fullname = os.path.join(path, name)
+            result[fullname] = os.stat(fullname).st_mtime_ns
+    return result
+
+
+# run in a new interpreter, the peak RSS is given by the process itself as
+# ru_maxrss of a child includes the memory of the parent before exec on Linux
+GALERIE_RUN = """\
+import sys, galerie
+galerie.main(sys.argv[1])
+try:
+    with open('/proc/self/status') as f:
+        peak = [int(line.split()[1]) / 1e3 for line in f if line.startswith('VmHWM:')][0]
+except OSError:
+    try:
+        import resource
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / (1e6 if sys.platform == 'darwin' else 1e3)
+    except ImportError:
+        peak = None
+print(peak, file=sys.stderr)
+"""
+
+
+def run_galerie(argstring, dest):
+    """
+    Run galerie in a new interpreter. Return wall time, peak RSS (MB, when
+    available), number of files created, modified or removed in dest and time
+    of each phase given by --profile.
+    """
+    before = snapshot(dest)
+    env = dict(os.environ, PYTHONPATH=os.path.dirname(galerie.__file__))
+    t0 = time.perf_counter()
+    process = subprocess.run([sys.executable, '-c', GALERIE_RUN, argstring + ' --profile'], env=env,
+                             stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True)
+    wall = time.perf_counter() - t0
+    if process.returncode != 0:
+        print('Error running galerie', argstring)
+        print(process.stderr)
+        rss = None
+    else:
+        peak = process.stderr.split()[-1]
+        rss = None if peak == 'None' else float(peak)
+
+    # the profile is not an output of the gallery
+    phases = dict()
+    profile = os.path.join(dest, galerie.PROFILE_NAME)
+    if os.path.exists(profile):
+        with open(profile) as f:
+            phases = {name: round(stats['time'], 3) for name, stats in json.load(f)['phases'].items()}
+        os.remove(profile)
+
+    after = snapshot(dest)
+    touched = sum(1 for name, mtime in after.items() if before.get(name) != mtime)
+    touched += len(before.keys() - after.keys())
+    return dict(wall=round(wall, 3), peak_rss_mb=rss, files_touched=touched, phases=phases)
+
+
+GALLERY_MODES = {
+    'bydate': '--gallery {dest} --sourcedir {tree} --bydate true --recursive true',
+    'bydir': '--gallery {dest} --sourcedir {tree} --bydir true',
+    'diary': '--gallery {tree} --diary true --dest {dest}',
+    'recursive': '--gallery {dest} --sourcedir {tree} --recursive true',
+}
+
+
+# -- Benchmarks ---------------------------------------------------------------
+
+
+def bench_thumbnails(scale='1'):
+    scale = int(scale)
+    tmpdir = tempfile.mkdtemp()
+    try:
+        images = test_images(tmpdir, scale)
+        width, height = Image.open(images[0]).size
+        print(f'{len(images)} images, {width}x{height}')
+
+        def make_thumbnails(thumbmode):
+            for image in images:
+                thumb_name = os.path.join(tmpdir, thumbmode + '-' + os.path.basename(image))
+                imgobj = Image.open(image)
+                size = galerie.size_thumbnail(*imgobj.size, 300)
+                galerie.create_thumbnail_image(image, [(thumb_name, size)], thumbmode)
+
+        results = dict()
+        for thumbmode in ('quality', 'speed'):
+            results[thumbmode] = timeit(make_thumbnails, thumbmode)
+            print(f'{thumbmode:10} {results[thumbmode]:8.3f} s  '
+                  f'{results[thumbmode] / len(images) * 1000:8.1f} ms/image')
+        print(f'speedup    {results["quality"] / results["speed"]:8.2f}')
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+def bench_diary(size='50'):
+    size = float(size) * 1e6
+    tmpdir = tempfile.mkdtemp()
+    try:
+        results = list()
+        for fraction in (0.25, 0.5, 1):
+            filename = os.path.join(tmpdir, 'index.md')
+            test_diary(filename, size * fraction)
+            mbytes = os.path.getsize(filename) / 1e6
+            elapsed = timeit(galerie.parse_markdown, filename, repeat=1)
+            results.append(elapsed / mbytes)
+            print(f'{mbytes:8.1f} MB  {elapsed:8.3f} s  {mbytes / elapsed:8.1f} MB/s')
+        print(f'ratio of times per MB (1 if linear) {results[-1] / results[0]:8.2f}')
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+def bench_startup():
+    env = dict(os.environ, PYTHONPATH=os.path.dirname(galerie.__file__))
+    tmpdir = tempfile.mkdtemp()
+    try:
+        commands = (
+            ('python', 'pass'),
+            ('import', 'import galerie'),
+            ('--setcfg', f'import galerie; galerie.main("--setcfg {tmpdir} source sourcedir .")'),
+        )
+        for name, command in commands:
+            elapsed = timeit(lambda: subprocess.run([sys.executable, '-c', command], env=env, check=True),
+                             repeat=10)
+            print(f'{name:10} {elapsed * 1000:8.1f} ms')
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+def bench_gallery(photos='200', videos='0', resolution='1600x1200', depth='2', diary='50',
+                  modes=','.join(GALLERY_MODES), output='benchmark-gallery.json'):
+    params = dict(photos=int(photos), videos=int(videos), resolution=resolution,
+                  depth=int(depth), diary=int(diary))
+    if params['videos'] and shutil.which('ffmpeg') is None:
+        print('ffmpeg not found, no videos')
+        params['videos'] = 0
+
+    tmpdir = tempfile.mkdtemp()
+    try:
+        tree = os.path.join(tmpdir, 'tree')
+        t0 = time.perf_counter()
+        dirs = synthetic_tree(tree, **params)
+        elapsed = time.perf_counter() - t0
+        print(f'Tree: {params["photos"]} photos, {params["videos"]} videos, {dirs} directories, '
+              f'{params["diary"]} posts in {elapsed:.1f} s')
+
+        results = dict(params=params, python=sys.version.split()[0], platform=platform.platform(),
+                       generation=round(elapsed, 3), runs=list())
+        print(f'{"mode":10} {"run":5} {"wall (s)":>9} {"rss (MB)":>9} {"files":>7}')
+        for mode in modes.split(','):
+            dest = os.path.join(tmpdir, mode)
+            os.mkdir(dest)
+            argstring = GALLERY_MODES[mode].format(dest=dest, tree=tree)
+            for run in ('cold', 'warm'):
+                result = run_galerie(argstring, dest)
+                print(f'{mode:10} {run:5} {result["wall"]:9.2f} {result["peak_rss_mb"] or 0:9.1f} '
+                      f'{result["files_touched"]:7}')
+                results['runs'].append(dict(mode=mode, run=run, **result))
+            if mode == 'diary':
+                os.remove(os.path.join(tree, '.config.ini'))
+    finally:
+        shutil.rmtree(tmpdir)
+
+    with open(output, 'wt') as f:
+        json.dump(results, f, indent=4)
+    print('Results saved in', os.path.abspath(output))
+
+
+# -- Main ---------------------------------------------------------------------
+
+
+def main():
+    if not sys.argv[1:]:
+        print(__doc__)
+        sys.exit(1)
+
+    name, params = sys.argv[1], sys.argv[2:]
+    bench = globals().get('bench_' + name)
+    if bench is None:
+        print(__doc__)
+        sys.exit(1)
+    args = [param for param in params if '=' not in param]
+    kwargs = dict(param.split('=', 1) for param in params if '=' in param)
+    bench(*args, **kwargs)
+
+
+try:
+    current_path = os.path.abspath(os.getcwd())
+    os.chdir(os.path.dirname(os.path.realpath(__file__)))
+    main()
+finally:
+    os.chdir(current_path)
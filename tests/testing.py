@@ -21,6 +21,9 @@ import shutil
 import glob
 import locale
 import io
+import subprocess
+import json
+import contextlib
 
 import colorama
 
@@ -154,6 +157,35 @@ def populate_tmp():
         shutil.copyfile(basename, os.path.join('tmp', basename))
 
 
+def populate_source(dirname, basenames):
+    os.makedirs(dirname, exist_ok=True)
+    for basename in basenames:
+        shutil.copyfile(basename, os.path.join(dirname, os.path.basename(basename)))
+
+
+def galerie_output(argstring):
+    # run galerie and return its standard output
+    with contextlib.redirect_stdout(io.StringIO()) as output:
+        galerie.main(argstring)
+    return output.getvalue()
+
+
+def output_mtimes(dirname):
+    # modification times of the files of a gallery and of its thumbnails
+    # except the catalog which is written by every build
+    mtimes = dict()
+    for root, _, filenames in os.walk(dirname):
+        for filename in filenames:
+            if filename != '.catalog.db':
+                fullname = os.path.join(root, filename)
+                mtimes[os.path.relpath(fullname, dirname).replace(os.sep, '/')] = os.stat(fullname).st_mtime_ns
+    return mtimes
+
+
+def changed_outputs(mtimes1, mtimes2):
+    return sorted(name for name in mtimes2 if mtimes2[name] != mtimes1.get(name))
+
+
 def test_18_gallery(mode):
     # create gallery when not existing
     remove_tmp()
@@ -246,6 +278,16 @@ def test_05_gallery(mode):
         )
 
 
+def test_05_gallery_jobs(mode):
+    # thumbnails made by worker processes give the same gallery
+    return generic_test(
+        mode,
+        False,
+        'test_05_gallery',
+        '--gallery tmp --source . --bydir true --bydate true --jobs 2'
+        )
+
+
 def test_16_gallery(mode):
     # test --update
     reset_tmp()
@@ -262,6 +304,499 @@ def test_16_gallery(mode):
         os.rename('TOC_20000101_000000.jpg', 'OCT_20000101_000000.jpg')
 
 
+def test_thumbmode_speed(mode):
+    # thumbnails made with reduced decoding (640x424 image decoded at half
+    # scale) have the requested size, also for formats where draft() does nothing
+    from PIL import Image
+    reset_tmp()
+    with Image.open('OCT_20000101_000000.jpg') as img:
+        img.save('tmp/image.png')
+    for image_name in ('OCT_20000101_000000.jpg', 'tmp/image.png'):
+        thumbs = [('tmp/thumb.jpg', (50, 50)), ('tmp/thumb@2x.jpg', (100, 100))]
+        galerie.create_thumbnail_image(image_name, thumbs, 'speed')
+        for thumb_name, size in [('tmp/thumb.jpg', (50, 33)), ('tmp/thumb@2x.jpg', (100, 66))]:
+            with Image.open(thumb_name) as img:
+                if img.size != size:
+                    return False
+    return True
+
+
+def test_ffprobe_output(mode):
+    # parse json output of ffprobe, rotated video and missing average frame rate
+    output = '''{
+        "streams": [{"width": 1920, "height": 1080, "avg_frame_rate": "0/0",
+                     "r_frame_rate": "30/1", "side_data_list": [{"rotation": -90}]}],
+        "format": {"duration": "65.400000"}
+    }'''
+    if galerie.parse_ffprobe_output(output) != (1080, 1920, 30.0, 65):
+        return False
+    try:
+        galerie.parse_ffprobe_output('{"streams": []}')
+        return False
+    except ValueError:
+        return True
+
+
+def test_probe_errors(mode):
+    # videos which cannot be probed, including videos removed since the scan,
+    # do not stop the other probes and are probed again only when changed
+    reset_tmp()
+    populate_source('tmp/source', ['OCT_20000101_000000.jpg'])
+    for basename in ('VID_20000107_000000.mp4', 'VID_20000107_000001.mp4'):
+        with open(f'tmp/source/{basename}', 'wb') as f:
+            f.write(b'not a video')
+    make_video_info = galerie.make_video_info
+    probed = []
+
+    def failing_probe(filename, stat, date, time):
+        probed.append(os.path.basename(filename))
+        if filename.endswith('0.mp4'):
+            raise FileNotFoundError(filename)
+        raise ValueError('Incorrect ffprobe output')
+
+    galerie.make_video_info = failing_probe
+    try:
+        with contextlib.redirect_stdout(io.StringIO()):
+            galerie.main('--gallery tmp/gallery --source tmp/source')
+            galerie.main('--update tmp/gallery')
+            if sorted(probed) != ['VID_20000107_000000.mp4', 'VID_20000107_000001.mp4']:
+                return False
+            os.utime('tmp/source/VID_20000107_000001.mp4', ns=(0, 0))
+            galerie.main('--update tmp/gallery')
+    finally:
+        galerie.make_video_info = make_video_info
+    return sorted(probed) == ['VID_20000107_000000.mp4', 'VID_20000107_000001.mp4',
+                              'VID_20000107_000001.mp4']
+
+
+def test_html_pages(mode):
+    # leading undated post on index page, then pages of 2 days and per month
+    class Args:
+        paginate = 2
+    posts = [galerie.Post(date, '', []) for date in ('00000000', '20000101', '20000102',
+                                                     '20000102', '20000215', '20000301')]
+    pages = galerie.html_pages(Args, posts, 'index.htm')
+    if [(name, len(posts)) for name, posts, _ in pages] != [
+            ('index.htm', 1), ('index-20000101.htm', 3), ('index-20000215.htm', 2)]:
+        return False
+    Args.paginate = 'month'
+    pages = galerie.html_pages(Args, posts, 'index.htm')
+    return [name for name, _, _ in pages] == [
+        'index.htm', 'index-200001.htm', 'index-200002.htm', 'index-200003.htm']
+
+
+def test_profile(mode):
+    # --profile writes the time, calls and io counters of each phase, as read
+    # by benchmark.py
+    reset_tmp()
+    populate_source('tmp/source', ['OCT_20000101_000000.jpg'])
+    output = galerie_output('--gallery tmp/gallery --source tmp/source --profile')
+    with open(os.path.join('tmp/gallery', galerie.PROFILE_NAME)) as f:
+        report = json.load(f)
+    keys = {'time', 'calls', *galerie.PROFILE_COUNTERS}
+    return ('Profile:' in output and set(report) == {'total', 'phases'}
+            and {'image thumbnails', 'html', 'other'} <= set(report['phases'])
+            and all(set(stats) == keys for stats in report['phases'].values())
+            and sum(stats['time'] for stats in report['phases'].values()) <= report['total'] + 1e-6)
+
+
+def test_progress_events(mode):
+    # json lines events with throughput and eta from the items of the phase
+    stream = io.StringIO()
+    progress = galerie.Progress(stream)
+    with progress.phase('image thumbnails', 4):
+        progress.item_done('a.jpg', 0.5)
+        progress.item_done('b.jpg', 0.5, 'error')
+    events = [json.loads(line) for line in stream.getvalue().splitlines()]
+    if [event['event'] for event in events] != ['phase_start', 'item_done', 'item_done', 'phase_end']:
+        return False
+    event = events[2]
+    return (event['done'] == 2 and event['total'] == 4 and event['error'] == 'error'
+            and event['eta'] is not None and events[3]['done'] == 2)
+
+
+def test_source_tree_rescan(mode):
+    # rescan of a changed directory keeps known subdirectories and forgets
+    # removed ones
+    reset_tmp()
+    root = os.path.abspath('tmp')
+    os.makedirs(os.path.join(root, 'a', 'b'))
+    os.makedirs(os.path.join(root, 'c'))
+    tree = galerie.SourceTree(root)
+    node_a = tree.nodes[os.path.join(root, 'a')]
+    shutil.rmtree(os.path.join(root, 'c'))
+    os.makedirs(os.path.join(root, 'd'))
+    with open(os.path.join(root, 'd', 'x.jpg'), 'wb'):
+        pass
+    tree.rescan(root)
+    return (tree.nodes[os.path.join(root, 'a')] is node_a
+            and os.path.join(root, 'c') not in tree.nodes
+            and list(tree.nodes[os.path.join(root, 'd')].files) == ['x.jpg'])
+
+
+def test_lazy_imports(mode):
+    # importing galerie and running a command without medias must not import
+    # heavy dependencies
+    command = ('import sys, galerie;'
+               'galerie.main("--setcfg tmp source sourcedir .");'
+               'print(" ".join(sorted({"PIL", "markdown", "lxml", "clipboard"} & set(sys.modules))))')
+    env = dict(os.environ, PYTHONPATH=os.path.dirname(inspect.getfile(galerie)))
+    output = subprocess.run([sys.executable, '-c', command], env=env, capture_output=True, text=True)
+    return output.returncode == 0 and output.stdout.strip() == ''
+
+
+def test_catalog_migration(mode):
+    # the .info files of galleries made before the catalog are moved into the
+    # catalog, medias are described again when their size or date change
+    reset_tmp()
+    populate_source('tmp/source', ['OCT_20000101_000000.jpg', 'VID_20000107_000000.mp4'])
+    os.makedirs('tmp/gallery/.thumbnails')
+    info_name = 'tmp/gallery/.thumbnails/dcim-VID_20000107_000000.mp4.info'
+    with open(info_name, 'wt') as f:
+        print('20000107 000000 1920 1080 5.0 65 30.0', file=f)
+    make_video_info = galerie.make_video_info
+    probed = []
+
+    def video_info(filename, stat, date, time):
+        probed.append(os.path.basename(filename))
+        return date, time, 640, 480, 1.0, 10, 25.0
+
+    galerie.make_video_info = video_info
+    try:
+        with contextlib.redirect_stdout(io.StringIO()):
+            galerie.main('--gallery tmp/gallery --source tmp/source')
+            with open('tmp/gallery/index.htm') as f:
+                html = f.read()
+            if probed or os.path.exists(info_name) or 'dim=1920x1080' not in html or 'dim=640x424' not in html:
+                return False
+            galerie.main('--update tmp/gallery')
+            if probed:
+                return False
+            os.utime('tmp/source/VID_20000107_000000.mp4', ns=(0, 0))
+            shutil.copyfile('OCT_20000104_000000.jpg', 'tmp/source/OCT_20000101_000000.jpg')
+            galerie.main('--update tmp/gallery')
+    finally:
+        galerie.make_video_info = make_video_info
+    with open('tmp/gallery/index.htm') as f:
+        html = f.read()
+    return probed == ['VID_20000107_000000.mp4'] and 'dim=640x480' in html and 'dim=640x361' in html
+
+
+def test_markdown_cache(mode):
+    # cached fragments give the same html, are invalidated by a new version of
+    # markdown and pruned when no page uses them
+    import markdown
+    reset_tmp()
+
+    class Args:
+        catalog = galerie.MediaCatalog('tmp')
+        profiler = galerie.Profiler()
+
+    text = 'Some *markdown* text'
+    try:
+        html = galerie.render_markdown(Args, text)
+        if galerie.render_markdown(Args, text) != html or Args.catalog.fragment_hits != 1:
+            return False
+        version = markdown.__version__
+        try:
+            markdown.__version__ = version + '.test'
+            galerie.render_markdown(Args, text)
+        finally:
+            markdown.__version__ = version
+        if Args.catalog.fragment_misses != 2:
+            return False
+
+        Args.catalog.record_page_fragments('index.htm')
+        Args.catalog.prune_fragments({'index.htm'})
+        galerie.render_markdown(Args, text)
+        if Args.catalog.fragment_misses != 2:
+            return False
+        Args.catalog.prune_fragments(set())
+        return galerie.render_markdown(Args, text) == html and Args.catalog.fragment_misses == 3
+    finally:
+        Args.catalog.close()
+
+
+def test_shared_cache(mode):
+    # a second gallery reuses the thumbnails of the shared cache, thumbnails
+    # made again in a gallery do not change the cache
+    reset_tmp()
+    populate_source('tmp/source', glob.glob('OCT_2000010[1-4]*.jpg'))
+    for gallery in ('g1', 'g2'):
+        os.makedirs(f'tmp/{gallery}')
+        galerie.main(f'--setcfg tmp/{gallery} thumbnails shared_cache ../cache')
+    output1 = galerie_output('--gallery tmp/g1 --source tmp/source')
+    output2 = galerie_output('--gallery tmp/g2 --source tmp/source')
+    if 'Shared cache: 0 thumbnails reused, 4 stored' not in output1:
+        return False
+    if 'Shared cache: 4 thumbnails reused, 0 stored' not in output2:
+        return False
+
+    cache = {}
+    for fn in glob.glob('tmp/cache/*/*'):
+        with open(fn, 'rb') as f:
+            cache[fn] = f.read()
+    galerie.setconfig('tmp/g2/.config.ini', 'thumbnails', 'shared_cache', '')
+    galerie.setconfig('tmp/g2/.config.ini', 'thumbnails', 'quality', '20')
+    galerie.main('--update tmp/g2 --forcethumb')
+    for fn, content in cache.items():
+        with open(fn, 'rb') as f:
+            if f.read() != content:
+                return False
+    return len(cache) == 4
+
+
+def test_incremental_update(mode):
+    # --update rewrites only the outputs of the changed medias
+    reset_tmp()
+    populate_source('tmp/source', ['OCT_20000101_000000.jpg'])
+    populate_source('tmp/source/a', ['OCT_20000103_000000.jpg', 'OCT_20000104_000000.jpg'])
+    populate_source('tmp/source/a/b', ['OCT_20000105_000000.jpg'])
+    galerie.main('--gallery tmp/gallery --source tmp/source --bydir true')
+
+    mtimes1 = output_mtimes('tmp/gallery')
+    if 'Outputs: 0 rebuilt, 5 skipped' not in galerie_output('--update tmp/gallery'):
+        return False
+    os.utime('tmp/source/a/OCT_20000103_000000.jpg')
+    galerie.main('--update tmp/gallery')
+    mtimes2 = output_mtimes('tmp/gallery')
+    if changed_outputs(mtimes1, mtimes2):
+        return False
+
+    populate_source('tmp/source/a/b', ['OCT_20000106_000000.jpg'])
+    output = galerie_output('--update tmp/gallery')
+    mtimes3 = output_mtimes('tmp/gallery')
+    return 'Outputs: 3 rebuilt, 2 skipped' in output and changed_outputs(mtimes2, mtimes3) == [
+        '.thumbnails/dcim-a.jpg', '.thumbnails/dcim-a_b.jpg',
+        '.thumbnails/dcim-a_b_OCT_20000106_000000.jpg.jpg', 'a_b.htm']
+
+
+def test_mosaic_fingerprint(mode):
+    # mosaics are composed again when a child thumbnail changes, with the
+    # mosaics of the enclosing directories, and only then
+    reset_tmp()
+    populate_source('tmp/source/a', ['OCT_20000103_000000.jpg', 'OCT_20000104_000000.jpg'])
+    populate_source('tmp/source/a/b', ['OCT_20000105_000000.jpg'])
+    populate_source('tmp/source/a/b/c', ['OCT_20000106_000000.jpg'])
+    galerie.main('--gallery tmp/gallery --source tmp/source --bydir true')
+
+    mtimes1 = output_mtimes('tmp/gallery')
+    if 'Making thumbnail' in galerie_output('--update tmp/gallery'):
+        return False
+    os.remove('tmp/gallery/.thumbnails/dcim-a_b_c_OCT_20000106_000000.jpg.jpg')
+    galerie.main('--update tmp/gallery')
+    mtimes2 = output_mtimes('tmp/gallery')
+    return changed_outputs(mtimes1, mtimes2) == [
+        '.thumbnails/dcim-a.jpg', '.thumbnails/dcim-a_b.jpg', '.thumbnails/dcim-a_b_c.jpg',
+        '.thumbnails/dcim-a_b_c_OCT_20000106_000000.jpg.jpg']
+
+
+def test_virtual_grid(mode):
+    # with a virtual grid, the items of the pages are given by json files
+    reset_tmp()
+    populate_source('tmp/source', ['OCT_20000101_000000.jpg', 'OCT_20000103_000000.jpg'])
+    os.makedirs('tmp/gallery')
+    galerie.main('--setcfg tmp/gallery thumbnails grid virtual')
+    galerie.main('--gallery tmp/gallery --source tmp/source')
+
+    with open('tmp/gallery/index.htm') as f:
+        html = f.read()
+    with open('tmp/gallery/.thumbnails/index.json') as f:
+        data = json.load(f)
+    if "vgrid('.thumbnails/index.json')" not in html or 'dcim-OCT_20000101_000000' in html:
+        return False
+    if [f'data-gallery="{key}"' in html for key in data] != [True]:
+        return False
+    items = list(data.values())[0]
+    return ([item[0] for item in items] == ['../source/OCT_20000101_000000.jpg',
+                                             '../source/OCT_20000103_000000.jpg']
+            and all(os.path.isfile(os.path.join('tmp/gallery', item[1])) for item in items)
+            and all(item[2] == 300 and item[5] == 0 for item in items))
+
+
+def test_thumbnail_format(mode):
+    # switching to webp thumbnails converts the thumbnails and purges the jpeg
+    # ones
+    reset_tmp()
+    populate_source('tmp/source', ['OCT_20000101_000000.jpg'])
+    populate_source('tmp/source/a', ['OCT_20000103_000000.jpg', 'OCT_20000104_000000.jpg'])
+    galerie.main('--gallery tmp/gallery --source tmp/source --bydir true')
+    galerie.setconfig('tmp/gallery/.config.ini', 'thumbnails', 'format', 'webp')
+    output = galerie_output('--update tmp/gallery')
+
+    thumbnails = sorted(os.listdir('tmp/gallery/.thumbnails'))
+    with open('tmp/gallery/index.htm') as f:
+        html = f.read()
+    return ('Thumbnail format: 4 thumbnails converted to webp' in output
+            and thumbnails == ['.catalog.db', '.nomedia', 'dcim-OCT_20000101_000000.jpg.webp',
+                               'dcim-a.webp', 'dcim-a_OCT_20000103_000000.jpg.webp',
+                               'dcim-a_OCT_20000104_000000.jpg.webp']
+            and '.jpg.jpg' not in html and 'dcim-a.webp' in html)
+
+
+def test_lazy_thumbnails(mode):
+    # a job is run once, on first request of its thumbnail and after the jobs
+    # of the thumbnails it depends on
+    reset_tmp()
+    calls = []
+
+    def make_thumbnail(image_name, thumbs):
+        calls.append(image_name)
+        galerie.create_thumbnail_image(image_name, thumbs)
+
+    lazy = galerie.LazyThumbnails([])
+    lazy.add(['tmp/a.jpg'], (make_thumbnail, ('OCT_20000101_000000.jpg', [('tmp/a.jpg', (300, 300))])))
+    lazy.add(['tmp/b.jpg'], (make_thumbnail, ('OCT_20000103_000000.jpg', [('tmp/b.jpg', (300, 300))])),
+             ['tmp/a.jpg'])
+    if lazy.make('tmp/c.jpg') is not False or calls:
+        return False
+    if not (lazy.make('tmp/b.jpg') and lazy.make('tmp/a.jpg') and lazy.make('tmp/b.jpg')):
+        return False
+    return (calls == ['OCT_20000101_000000.jpg', 'OCT_20000103_000000.jpg']
+            and os.path.isfile('tmp/a.jpg') and os.path.isfile('tmp/b.jpg'))
+
+
+def test_serve_gallery(mode):
+    # thumbnails are made on request, other missing files are not found and a
+    # port already in use is an error
+    import socket
+    import urllib.request
+    import urllib.error
+    reset_tmp()
+
+    class Args:
+        dest = os.path.abspath('tmp')
+        rootname = ''
+        lazythumbs = galerie.LazyThumbnails([])
+
+    thumb_name = os.path.join(Args.dest, 'a.jpg')
+    Args.lazythumbs.add([thumb_name], (galerie.create_thumbnail_image,
+                                       ('OCT_20000101_000000.jpg', [(thumb_name, (300, 300))])))
+    with socket.socket() as sock:
+        if hasattr(socket, 'SO_EXCLUSIVEADDRUSE'):
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_EXCLUSIVEADDRUSE, 1)
+        sock.bind(('127.0.0.1', 0))
+        sock.listen()
+        Args.serve = sock.getsockname()[1]
+        try:
+            with contextlib.redirect_stdout(io.StringIO()):
+                galerie.serve_gallery(Args)
+            return False
+        except SystemExit as exception:
+            if exception.args[0] != galerie.errorcode('Unable to serve gallery'):
+                return False
+
+    with contextlib.redirect_stdout(io.StringIO()):
+        server, thread = galerie.serve_gallery(Args)
+    try:
+        with urllib.request.urlopen(f'http://127.0.0.1:{Args.serve}/a.jpg') as response:
+            content = response.read()
+        with open(thumb_name, 'rb') as f:
+            if content != f.read():
+                return False
+        try:
+            urllib.request.urlopen(f'http://127.0.0.1:{Args.serve}/b.jpg')
+            return False
+        except urllib.error.HTTPError as exception:
+            return exception.code == 404
+    finally:
+        server.shutdown()
+        server.server_close()
+        thread.join()
+
+
+def test_watch_new_directory(mode):
+    # files copied into a new directory while the gallery is updated are
+    # detected at next poll
+    reset_tmp()
+    populate_source('tmp/source', ['OCT_20000101_000000.jpg'])
+    build_gallery, wait = galerie.build_gallery, galerie.SourceWatcher.wait
+    changes = []
+
+    def build_gallery_copying(args):
+        if len(changes) == 1:
+            populate_source('tmp/source/a', ['OCT_20000104_000000.jpg'])
+        build_gallery(args)
+
+    def scripted_wait(watcher):
+        if not changes:
+            populate_source('tmp/source/a', ['OCT_20000103_000000.jpg'])
+            changes.append(wait(watcher))
+            return changes[-1]
+        changes.append(watcher.poll())
+        raise KeyboardInterrupt
+
+    galerie.build_gallery, galerie.SourceWatcher.wait = build_gallery_copying, scripted_wait
+    try:
+        with contextlib.redirect_stdout(io.StringIO()):
+            galerie.main('--gallery tmp/gallery --source tmp/source --watch 0.05')
+    finally:
+        galerie.build_gallery, galerie.SourceWatcher.wait = build_gallery, wait
+    return ([{os.path.basename(name) for name in dirnames} for dirnames, _ in changes]
+            == [{'source'}, {'a'}])
+
+
+def test_hidpi(mode):
+    # thumbnails at double resolution are made for large enough images only,
+    # given with srcset and purged when hidpi is disabled
+    from PIL import Image
+    reset_tmp()
+    populate_source('tmp/source', ['OCT_20000101_000000.jpg'])
+    Image.new('RGB', (400, 300), 'white').save('tmp/source/small.jpg')
+    os.makedirs('tmp/gallery')
+    galerie.main('--setcfg tmp/gallery thumbnails hidpi true')
+    galerie.main('--gallery tmp/gallery --source tmp/source')
+
+    thumb2x = 'dcim-OCT_20000101_000000.jpg@2x.jpg'
+    if [os.path.basename(name) for name in glob.glob('tmp/gallery/.thumbnails/*@2x*')] != [thumb2x]:
+        return False
+    with Image.open(f'tmp/gallery/.thumbnails/{thumb2x}') as img:
+        if img.size[0] != 600:
+            return False
+    with open('tmp/gallery/index.htm') as f:
+        html = f.read()
+    if f'.thumbnails/{thumb2x} 600w' not in html or html.count('srcset=') != 1:
+        return False
+
+    galerie.setconfig('tmp/gallery/.config.ini', 'thumbnails', 'hidpi', 'false')
+    galerie.main('--update tmp/gallery')
+    with open('tmp/gallery/index.htm') as f:
+        html = f.read()
+    return not glob.glob('tmp/gallery/.thumbnails/*@2x*') and 'srcset=' not in html
+
+
+def test_sprites(mode):
+    # the thumbnails of each dcim block are drawn from a sprite, a changed
+    # media makes again only the sprite of its block
+    from PIL import Image
+    reset_tmp()
+    populate_source('tmp/source', ['OCT_20000101_000000.jpg', 'OCT_20000103_000000.jpg',
+                                   'OCT_20000104_000000.jpg'])
+    populate_source('tmp/source/a', ['OCT_20000105_000000.jpg', 'OCT_20000106_000000.jpg'])
+    os.makedirs('tmp/gallery')
+    galerie.main('--setcfg tmp/gallery thumbnails sprites true')
+    galerie.setconfig('tmp/gallery/.config.ini', 'thumbnails', 'hidpi', 'true')
+    galerie.main('--gallery tmp/gallery --source tmp/source --bydir true')
+
+    sprite = '.thumbnails/sprite-dcim-OCT_20000101_000000.jpg.jpg'
+    with open('tmp/gallery/index.htm') as f:
+        backgrounds = re.findall(r"background: url\('([^']+)'\) -(\d+)px -(\d+)px", f.read())
+    if backgrounds != [(sprite, '0', '0'), (sprite, '300', '0'), (sprite, '600', '0')]:
+        return False
+    with Image.open(os.path.join('tmp/gallery', sprite)) as img:
+        if img.size != (900, 200):
+            return False
+    if glob.glob('tmp/gallery/.thumbnails/*@2x*'):
+        return False
+
+    mtimes1 = output_mtimes('tmp/gallery')
+    shutil.copyfile('OCT_20000107_000000.jpg', 'tmp/source/a/OCT_20000106_000000.jpg')
+    galerie.main('--update tmp/gallery')
+    mtimes2 = output_mtimes('tmp/gallery')
+    sprites = [name for name in changed_outputs(mtimes1, mtimes2) if 'sprite-' in name]
+    return sprites == ['.thumbnails/sprite-dcim-a_OCT_20000105_000000.jpg.jpg']
+
+
 def test_update_incorrect_parameter(mode):
     # test --update with incorrect parameter
     reset_tmp()
@@ -335,6 +870,26 @@ def test_purge_html(mode):
         sys.stdin = stdin
 
 
+def test_purge_report(mode):
+    # --purge_report lists the orphan outputs without removing them
+    reset_tmp()
+    populate_source('tmp/source', ['OCT_20000101_000000.jpg', 'OCT_20000103_000000.jpg'])
+    galerie.main('--gallery tmp/gallery --source tmp/source --bydir true')
+    os.remove('tmp/source/OCT_20000103_000000.jpg')
+    for name in ('old.htm', '.thumbnails/dcim-old.jpg.info'):
+        with open(os.path.join('tmp/gallery', name), 'wt') as f:
+            f.write('orphan')
+    orphans = ['.thumbnails/dcim-OCT_20000103_000000.jpg.jpg', '.thumbnails/dcim-old.jpg.info', 'old.htm']
+
+    output = galerie_output('--update tmp/gallery --purge_report')
+    if 'Purge report: 3 files to remove' not in output:
+        return False
+    if not all(f' {name}\n' in output and os.path.isfile(f'tmp/gallery/{name}') for name in orphans):
+        return False
+    galerie.main('--update tmp/gallery')
+    return not any(os.path.exists(f'tmp/gallery/{name}') for name in orphans)
+
+
 def test_06_gallery(mode):
     return generic_test(
         mode,
@@ -425,6 +980,76 @@ ______
         return exception.args[0] == galerie.errorcode('Posts are not ordered')
 
 
+def diary_error(diary):
+    # build a diary gallery and return the exit code and the error message
+    reset_tmp()
+    with open('tmp/index.md', 'wt') as f:
+        f.write(diary)
+    with contextlib.redirect_stdout(io.StringIO()) as output:
+        try:
+            galerie.main('--gallery tmp --diary true')
+            return None, output.getvalue()
+        except SystemExit as exception:
+            return exception.args[0], output.getvalue()
+
+
+def test_lastdate_pages(mode):
+    # a page using {LASTDATE} is written again when a day is added to a later
+    # page
+    reset_tmp()
+    diary = '''\
+[2020/01/01]
+Go to the [last day](index-202002.htm#{LASTDATE})
+______
+[2020/02/01]
+Some text
+______
+'''
+    with open('tmp/index.md', 'wt') as f:
+        f.write(diary)
+    galerie.main('--setcfg tmp source paginate month')
+    galerie.main('--gallery tmp --diary true --daily_anchors true')
+    with open('tmp/index.md', 'at') as f:
+        f.write('[2020/02/02]\nSome text\n______\n')
+    galerie.main('--gallery tmp --diary true --daily_anchors true')
+    with open('tmp/index-202001.htm') as f:
+        return '#20200202' in f.read()
+
+
+def test_diary_error_lines(mode):
+    # error messages give the line of the incorrect post
+    code, output = diary_error('''\
+[2020/01/01]
+______
+[2020/01/02]
+Some text
+______
+[2020/02/30]
+______
+    ''')
+    if code != galerie.errorcode('Incorrect date value:') or '20200230 (line 6)' not in output:
+        return False
+    code, output = diary_error('''\
+[2020/01/01]
+______
+[2020/01/03]
+Some text
+______
+[2020/01/02]
+______
+    ''')
+    return code == galerie.errorcode('Posts are not ordered') and '(line 6)' in output
+
+
+def test_diary_empty(mode):
+    # an empty diary or a post without text and medias make a gallery
+    for diary in ('', '[2020/01/01]\n______\n'):
+        code, output = diary_error(diary)
+        if code is not None or not os.path.isfile('tmp/index.htm'):
+            return False
+    return True
+
+
 def test_15_gallery(mode):
     if mode == 'ref':
         return None